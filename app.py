@@ -1,14 +1,19 @@
 from PyQt5 import QtCore, QtWidgets
-from PyQt5.QtWidgets import QFileDialog, QListWidgetItem
-from widgets import ImageViewer, PageLabel
+from PyQt5.QtWidgets import QFileDialog
+from widgets import FirstPaint, ImageViewer, PageListModel, PageListView
+from scheduler import RenderScheduler, BackgroundTask, PRIORITY_CURRENT, PRIORITY_VISIBLE, PRIORITY_BACKGROUND
 
 ## Controller Imports
-from reportlab.pdfgen.canvas import Canvas
-from pdfrw import PdfReader, PdfWriter, PageMerge
-from pdfrw.buildxobj import pagexobj
-from pdfrw.toreportlab import makerl
-from pdf2image import convert_from_bytes
+from document import Document, write_document
+from instrument import recorder, span, TRACE_PATH
+from trim import trim_boxes
+from importer import read_files
+from export import export_images, export_ranges, page_ranges, describe, IMAGE_FORMATS
+from render import page_to_img, preview_dpi, render_range, contiguous_runs, thumbnail_from, DEFAULT_DPI, THUMBNAIL_DPI
+from cache import RenderCache, ThumbnailDiskCache, file_digest, file_stat
+import bisect
 import os
+import threading
 
 
 class Ui_MainWindow(object):
@@ -23,8 +28,9 @@ class Ui_MainWindow(object):
         self.splitter = QtWidgets.QSplitter(self.centralwidget)
         self.splitter.setOrientation(QtCore.Qt.Horizontal)
         self.splitter.setObjectName("splitter")
-        self.pageScrollArea = QtWidgets.QListWidget(self.splitter)
-        self.pageScrollArea.setStyleSheet("QListView::item { height: 100px; }")
+        self.pageModel = PageListModel(MainWindow)
+        self.pageScrollArea = PageListView(self.splitter)
+        self.pageScrollArea.setModel(self.pageModel)
 
         ####
 
@@ -43,6 +49,8 @@ class Ui_MainWindow(object):
         self.menubar.setObjectName("menubar")
         self.menuFile = QtWidgets.QMenu(self.menubar)
         self.menuFile.setObjectName("menuFile")
+        self.menuEdit = QtWidgets.QMenu(self.menubar)
+        self.menuEdit.setObjectName("menuEdit")
         MainWindow.setMenuBar(self.menubar)
         self.statusbar = QtWidgets.QStatusBar(MainWindow)
         self.statusbar.setObjectName("statusbar")
@@ -55,20 +63,37 @@ class Ui_MainWindow(object):
         self.actionSave.setObjectName("actionSave")
         self.actionSaveAs = QtWidgets.QAction(MainWindow)
         self.actionSaveAs.setObjectName("actionSaveAs")
+        self.actionExportImages = QtWidgets.QAction(MainWindow)
+        self.actionExportImages.setObjectName("actionExportImages")
+        self.actionSplit = QtWidgets.QAction(MainWindow)
+        self.actionSplit.setObjectName("actionSplit")
         self.actionEditMeta = QtWidgets.QAction(MainWindow)
         self.actionEditMeta.setObjectName("actionEditMeta")
+        self.actionUndo = QtWidgets.QAction(MainWindow)
+        self.actionUndo.setObjectName("actionUndo")
+        self.actionRedo = QtWidgets.QAction(MainWindow)
+        self.actionRedo.setObjectName("actionRedo")
 
         self.actionSave.setEnabled(False)
         self.actionSaveAs.setEnabled(False)
+        self.actionExportImages.setEnabled(False)
+        self.actionSplit.setEnabled(False)
         self.actionAddPages.setEnabled(False)
         self.actionEditMeta.setEnabled(False)
+        self.actionUndo.setEnabled(False)
+        self.actionRedo.setEnabled(False)
 
         self.menuFile.addAction(self.actionOpenPages)
         self.menuFile.addAction(self.actionAddPages)
         self.menuFile.addAction(self.actionSave)
         self.menuFile.addAction(self.actionSaveAs)
+        self.menuFile.addAction(self.actionExportImages)
+        self.menuFile.addAction(self.actionSplit)
         self.menuFile.addAction(self.actionEditMeta)
+        self.menuEdit.addAction(self.actionUndo)
+        self.menuEdit.addAction(self.actionRedo)
         self.menubar.addAction(self.menuFile.menuAction())
+        self.menubar.addAction(self.menuEdit.menuAction())
 
         self.retranslateUi(MainWindow)
         QtCore.QMetaObject.connectSlotsByName(MainWindow)
@@ -85,171 +110,493 @@ class Ui_MainWindow(object):
         self.actionSave.setShortcut(_translate("MainWindow", "Ctrl+S"))
         self.actionSaveAs.setText(_translate("MainWindow", "Save As"))
         self.actionSaveAs.setShortcut(_translate("MainWindow", "Ctrl+Shift+S"))
+        self.actionExportImages.setText(_translate("MainWindow", "Export Images"))
+        self.actionSplit.setText(_translate("MainWindow", "Split PDF"))
         self.actionEditMeta.setText(_translate("MainWindow", "Edit Meta"))
         self.actionEditMeta.setShortcut(_translate("MainWindow", "Ctrl+M"))
+        self.menuEdit.setTitle(_translate("MainWindow", "Edit"))
+        self.actionUndo.setText(_translate("MainWindow", "Undo"))
+        self.actionUndo.setShortcut(_translate("MainWindow", "Ctrl+Z"))
+        self.actionRedo.setText(_translate("MainWindow", "Redo"))
+        self.actionRedo.setShortcut(_translate("MainWindow", "Ctrl+Shift+Z"))
 
 
 class Controller:
 
-    def handle_item_click(self, clicked):
-        for i in range(len(ui.pageScrollArea)):
-            if clicked == ui.pageScrollArea.item(i):
-                self.show_page(i)
-        clicked.setSelected(True)
+    BATCH_SIZE = 16
+    # files up to this size are hashed while they are opened, larger ones in the background
+    INLINE_DIGEST_SIZE = 64 * 2 ** 20
+
+    def handle_item_click(self, index):
+        self.show_page(index.row())
+
+    def handle_thumbnail_request(self, page_no):
+        if page_no >= len(self.document.pages):
+            return
+        cache_key = self.render_key(page_no, "thumb")
+        image = self.render_cache.get(cache_key)
+        source = self.source_of(page_no)
+        if image is None and source is not None and source[2] is not None:
+            image = self.disk_cache.get(source[2], source[1], THUMBNAIL_DPI)
+            if image is not None:
+                self.render_cache.put(cache_key, image)
+
+        if image is not None:
+            ui.pageModel.set_thumbnail(page_no, image)
+        else:
+            self.request_thumbnail(page_no, PRIORITY_VISIBLE)
+
+    def handle_render_finished(self, key, result):
+        with span("deliver", kind=key[0]):
+            self.deliver_renders(key, result)
+
+    def deliver_renders(self, key, result):
+        self.release_batch(key)
+        for page_no, page, cache_key, image in result:
+            if cache_key is not None:
+                self.render_cache.put(cache_key, image)
+
+            # rows shift when pages are deleted, so only show renders of the page that is still at that row
+            if page_no >= len(self.document.pages) or self.document.pages[page_no] is not page:
+                continue
+
+            if key[0] == "tile":
+                self.tile_jobs.discard(key)
+                if page_no == self.current_page:
+                    ui.previewArea.set_tile(key[2], key[3], image)
+            elif key[0] == "preview":
+                if page_no == self.current_page:
+                    ui.previewArea.load_from_pil(image)
+                thumb_key = self.render_key(page_no, "thumb")
+                if thumb_key not in self.render_cache:
+                    thumbnail = thumbnail_from(image)
+                    self.render_cache.put(thumb_key, thumbnail)
+                    ui.pageModel.set_thumbnail(page_no, thumbnail)
+            else:
+                ui.pageModel.set_thumbnail(page_no, image)
+
+    def handle_render_failed(self, key, error):
+        self.release_batch(key)
+        ui.statusbar.showMessage("Could not render page " + str(key[1] + 1) + ": " + str(error))
+
+    def handle_tile_request(self, zoom, tiles):
+        page_no = self.current_page
+        wanted = set()
+        if page_no < len(self.document.pages):
+            page = self.document.pages[page_no]
+            page_width = page.size[0]
+            for tile, fraction, size in tiles:
+                key = ("tile", page_no, zoom, tile)
+                wanted.add(key)
+                if not self.scheduler.is_scheduled(key):
+                    dpi = size[0] / (fraction[2] * page_width) * 72
+                    self.scheduler.submit(key, self.render_tile, page_no, page, fraction, dpi,
+                                          priority=PRIORITY_CURRENT)
+
+        # tiles of other zoom levels or scrolled out of view are no longer worth rendering
+        for key in self.tile_jobs - wanted:
+            self.scheduler.cancel(key)
+        self.tile_jobs = wanted
 
     def handle_action(self, action: str):
-        print(action)
-        if action == "forward":
-            if self.current_page < len(self.pages) - 1:
-                self.show_page(self.current_page + 1)
-        elif action == "back":
-            if self.current_page > 0:
-                self.show_page(self.current_page - 1)
-        elif action == "first":
-            self.show_page(0)
-        elif action == "last":
-            self.show_page(len(self.pages) - 1)
-        elif action == "crop":
-            selection = ui.previewArea.get_selection()
-
-            info = PageMerge().add(self.pages[self.current_page])
-            x1, y1, x2, y2 = info.xobj_box
-
-            crop_section = x1 + selection[0] * (x2 - x1), y1 + selection[1] * (y2 - y1), \
-                           x1 + selection[2] * (x2 - x1), y1 + selection[3] * (y2 - y1)
-
-            crop_section = (crop_section[0], crop_section[1], crop_section[2] - crop_section[0], crop_section[3] - crop_section[1])
-
-            new_page = self.crop_page(self.pages[self.current_page], crop_section)
-            self.pages[self.current_page] = new_page
-            self.renders[self.current_page] = self.page_to_img(new_page)
-
-            ui.previewArea.load_from_pil(self.renders[self.current_page])
-            ui.pageScrollArea.itemWidget(ui.pageScrollArea.item(self.current_page)).set_image(self.renders[self.current_page])
-
-            ui.previewArea.imageLabel.deselect()
-            ui.previewArea.cropButton.setVisible(False)
-
-            self.set_saved(False)
-        elif action == "delete":
-            self.delete_selected()
-        elif action == "margin":
-            pass
-        elif action == "rotate":
-            self.rotate_selected()
-        elif action == "rescale":
-            pass
+        with span("action", action=action):
+            if action == "forward":
+                if self.current_page < len(self.document.pages) - 1:
+                    self.show_page(self.current_page + 1)
+            elif action == "back":
+                if self.current_page > 0:
+                    self.show_page(self.current_page - 1)
+            elif action == "first":
+                self.show_page(0)
+            elif action == "last":
+                self.show_page(len(self.document.pages) - 1)
+            elif action == "crop":
+                selection = ui.previewArea.get_selection()
+
+                self.document.crop([self.current_page], selection)
+                self.invalidate_renders([self.current_page])
+                self.request_preview(self.current_page)
+
+                ui.previewArea.imageLabel.deselect()
+                ui.previewArea.cropButton.setVisible(False)
+
+                self.set_saved(False)
+            elif action == "delete":
+                self.delete_selected()
+            elif action == "margin":
+                pass
+            elif action == "trim":
+                self.trim_selected()
+            elif action == "rotate":
+                self.rotate_selected()
+            elif action == "rescale":
+                pass
+
+    def selected_rows(self):
+        return sorted({model_idx.row() for model_idx in ui.pageScrollArea.selectedIndexes()})
 
     def delete_selected(self):
-        for model_idx in sorted(list(ui.pageScrollArea.selectedIndexes()), reverse=True):
-            idx = model_idx.row()
-
-            del self.pages[idx]
-            del self.renders[idx]
-            ui.pageScrollArea.takeItem(idx)
-
-            if idx == self.current_page:
-                self.show_page(self.current_page - 1)
+        rows = self.selected_rows()
+        if not rows:
+            return
+        self.document.delete(rows)
+        ui.pageModel.remove_pages(rows)
+        # the current page moves up by the number of deleted pages up to and including it
+        self.current_page = max(0, self.current_page - bisect.bisect_right(rows, self.current_page))
+
+        # queued jobs refer to rows that may have shifted
+        self.cancel_renders()
+        ui.pageModel.reset_requests()
+        if self.document.pages:
+            self.show_page(self.current_page)
 
         self.set_saved(False)
 
     def rotate_selected(self):
-        for model_idx in sorted(list(ui.pageScrollArea.selectedIndexes()), reverse=True):
-            idx = model_idx.row()
-
-            result = PageMerge()
-            result.add(self.pages[idx], rotate=90)
-            new_page = result.render()
-
-            self.pages[idx] = new_page
-            self.renders[idx] = self.page_to_img(new_page)
+        rows = self.selected_rows()
+        if not rows:
+            return
+        self.document.rotate(rows, 90)
+        # off-screen thumbnails are re-rendered lazily once they are scrolled into view
+        self.invalidate_renders(rows)
+        if self.current_page in rows:
+            self.request_preview(self.current_page)
 
-            ui.pageScrollArea.itemWidget(ui.pageScrollArea.item(idx)).set_image(
-                self.renders[idx])
-
-            if idx == self.current_page:
-                ui.previewArea.load_from_pil(self.renders[idx])
+        self.set_saved(False)
 
+    def trim_selected(self):
+        if self.trim_task is not None and self.trim_task.is_running():
+            ui.statusbar.showMessage("Still trimming, try again once the current pages are done")
+            return
+        rows = self.selected_rows()
+        if not rows:
+            return
+
+        document = self.document
+        pages = [document.pages[row] for row in rows]
+        self.trim_task = BackgroundTask(trim_boxes, pages, [self.source_of(row) for row in rows], parent=MainWindow)
+        self.trim_task.progress.connect(
+            lambda stage, done, total: ui.statusbar.showMessage("Trimming: " + str(done) + " / " + str(total)))
+        self.trim_task.finished.connect(lambda boxes: self.handle_trim_finished(document, rows, pages, boxes))
+        self.trim_task.failed.connect(lambda error: ui.statusbar.showMessage("Could not trim: " + str(error)))
+        self.trim_task.start()
+
+    def handle_trim_finished(self, document, rows, pages, boxes):
+        # pages edited while their margins were measured are left alone
+        selections = {row: box for row, page, box in zip(rows, pages, boxes)
+                      if box is not None and row < len(document.pages) and document.pages[row] is page}
+        if document is not self.document or not selections:
+            ui.statusbar.showMessage("Nothing to trim")
+            return
+
+        document.crop_each(selections)
+        self.invalidate_renders(list(selections))
+        if self.current_page in selections:
+            self.request_preview(self.current_page)
+        ui.statusbar.showMessage("Trimmed " + str(len(selections)) + " / " + str(len(rows)) + " pages")
         self.set_saved(False)
 
     def __init__(self):
+        self.scheduler = RenderScheduler(parent=MainWindow)
+        self.render_cache = RenderCache()
+        self.disk_cache = ThumbnailDiskCache()
+        self.batch_requests = dict()
+        self.batched = dict()
+        self.tile_jobs = set()
+        self.save_task = None
+        self.trim_task = None
+        self.export_task = None
+        self.import_task = None
+        self.scheduler.finished.connect(self.handle_render_finished)
+        self.scheduler.failed.connect(self.handle_render_failed)
         self.reset()
-        ui.pageScrollArea.itemClicked.connect(self.handle_item_click)
+        ui.pageScrollArea.clicked.connect(self.handle_item_click)
+        ui.pageScrollArea.actionEvent.connect(self.handle_action)
+        ui.pageModel.thumbnailRequested.connect(self.handle_thumbnail_request, QtCore.Qt.QueuedConnection)
         ui.actionOpenPages.triggered.connect(lambda: open_pdf())
+        ui.actionAddPages.triggered.connect(lambda: add_pdf())
+        ui.actionSave.triggered.connect(lambda: self.save())
+        ui.actionSaveAs.triggered.connect(lambda: save_pdf_as())
+        ui.actionExportImages.triggered.connect(lambda: export_images_dialog())
+        ui.actionSplit.triggered.connect(lambda: split_pdf_dialog())
+        ui.actionUndo.triggered.connect(lambda: self.undo())
+        ui.actionRedo.triggered.connect(lambda: self.redo())
         ui.previewArea.actionEvent.connect(self.handle_action)
+        ui.previewArea.tilesRequested.connect(self.handle_tile_request)
+
+        if recorder.enabled:
+            self.traceLabel = QtWidgets.QLabel()
+            ui.statusbar.addPermanentWidget(self.traceLabel)
+            self.traceTimer = QtCore.QTimer(MainWindow)
+            self.traceTimer.timeout.connect(
+                lambda: self.traceLabel.setText(recorder.summary() + " | " + self.render_cache.describe()))
+            self.traceTimer.start(1000)
+            QtWidgets.QApplication.instance().aboutToQuit.connect(
+                lambda: recorder.export(TRACE_PATH, render_cache=self.render_cache.stats()))
 
     def reset(self):
         self.current_page = 0
-        self.pages = list()
-        self.renders = list()
-        self.path = None
+        self.document = Document()
         self.saved = True
-        ui.pageScrollArea.clear()
+        self.cancel_renders()
+        ui.pageModel.clear()
         self.adjust_title()
 
     def set_saved(self, saved):
         self.saved = saved
         ui.actionSave.setEnabled(not self.saved)
+        ui.actionUndo.setEnabled(self.document.history.can_undo())
+        ui.actionRedo.setEnabled(self.document.history.can_redo())
         self.adjust_title()
 
+    def undo(self):
+        if self.document.history.can_undo():
+            self.show_history(self.document.undo())
+
+    def redo(self):
+        if self.document.history.can_redo():
+            self.show_history(self.document.redo())
+
+    def show_history(self, edit):
+        # the restored pages are the very objects shown before, so their renders come straight from the cache
+        kind, rows, _, _ = edit
+        if kind in ("delete", "add"):
+            self.cancel_renders()
+            ui.pageModel.reset_pages(len(self.document.pages))
+        else:
+            self.invalidate_renders(rows)
+        if self.document.pages:
+            self.show_page(min(self.current_page, len(self.document.pages) - 1))
+        self.set_saved(False)
+
     def show_page(self, page_no):
 
         if page_no < 0:
             page_no = 0
-        elif page_no >= len(self.pages):
-            page_no = len(self.pages) - 1
+        elif page_no >= len(self.document.pages):
+            page_no = len(self.document.pages) - 1
 
         self.current_page = page_no
-        ui.previewArea.load_from_pil(self.renders[self.current_page])
+
+        image = self.render_cache.get(self.render_key(page_no, "preview"))
+        if image is not None:
+            ui.previewArea.load_from_pil(image)
+        else:
+            self.request_preview(page_no)
+        if page_no + 1 < len(self.document.pages):
+            self.request_preview(page_no + 1, PRIORITY_BACKGROUND)
+
         ui.previewArea.pageTextEdit.setText(str(self.current_page + 1))
-        ui.pageScrollArea.item(page_no).setSelected(True)
-        ui.statusbar.showMessage("Page " + str(page_no + 1) + " / " + str(len(self.pages)))
+        ui.pageScrollArea.setCurrentIndex(ui.pageModel.index(page_no))
+        ui.statusbar.showMessage("Page " + str(page_no + 1) + " / " + str(len(self.document.pages)))
 
     def save(self, as_file=None):
 
-        if as_file is not None:
-            self.path = as_file
+        if self.save_task is not None and self.save_task.is_running():
+            ui.statusbar.showMessage("Still saving, try again once the current save is done")
+            return
+
+        # pages are immutable, so a copy of the list is a consistent snapshot while the user keeps editing
+        document = self.document
+        snapshot = list(document.pages)
+        # the document only takes the new name once it was written there
+        path = as_file if as_file is not None else document.path
+
+        self.save_task = BackgroundTask(write_document, snapshot, path, document.base, parent=MainWindow)
+        self.save_task.progress.connect(self.handle_save_progress)
+        self.save_task.finished.connect(lambda result: self.handle_save_finished(document, snapshot, path, *result))
+        self.save_task.failed.connect(self.handle_save_failed)
+
+        ui.actionSave.setEnabled(False)
+        ui.actionSaveAs.setEnabled(False)
+        self.save_task.start()
+
+    def handle_save_progress(self, stage, done, total):
+        if total:
+            ui.statusbar.showMessage("Saving: " + stage + " " + str(done) + " / " + str(total))
+        elif done:
+            ui.statusbar.showMessage("Saving: " + stage + " " + "%.1f MB" % (done / 2 ** 20))
+        else:
+            ui.statusbar.showMessage("Saving: " + stage)
+
+    def handle_save_finished(self, document, snapshot, path, incremental, digest):
+        ui.actionSaveAs.setEnabled(True)
+        if incremental:
+            ui.statusbar.showMessage("Saved changes to " + os.path.basename(path))
+        else:
+            ui.statusbar.showMessage("Saved " + os.path.basename(path))
+        if document is not self.document:
+            # another document was opened in the meantime
+            return
+
+        self.document.path = path
+        if self.document.saved(snapshot, digest):
+            # queued renders may refer to the old page positions
+            self.cancel_renders()
+            ui.pageModel.reset_requests()
+        pages = self.document.pages
+        unchanged = len(snapshot) == len(pages) and all(a is b for a, b in zip(snapshot, pages))
+        self.set_saved(unchanged)
+
+    def handle_save_failed(self, error):
+        ui.actionSave.setEnabled(True)
+        ui.actionSaveAs.setEnabled(True)
+        ui.statusbar.showMessage("Could not save: " + str(error))
+
+    def export_images(self, folder, dpi, image_format):
+        pages = list(self.document.pages)
+        sources = [self.source_of(row) for row in range(len(pages))]
+        self.export(export_images, pages, sources, folder, self.export_stem(), dpi, image_format)
 
-        writer = PdfWriter()
-        writer.addpages(self.pages)
-        writer.write(self.path)
+    def split_pdf(self, folder, ranges):
+        self.export(export_ranges, list(self.document.pages), ranges, folder, self.export_stem())
 
-        self.set_saved(True)
-        self.adjust_title()
+    def export_stem(self):
+        if self.document.path is None:
+            return "page"
+        return os.path.splitext(os.path.basename(self.document.path))[0]
+
+    def export(self, func, *args):
+        if self.export_task is not None and self.export_task.is_running():
+            ui.statusbar.showMessage("Still exporting, try again once the current export is done")
+            return
+
+        self.export_task = BackgroundTask(func, *args, parent=MainWindow)
+        self.export_task.progress.connect(
+            lambda stage, done, total: ui.statusbar.showMessage(stage + ": " + str(done) + " / " + str(total)))
+        self.export_task.finished.connect(lambda stats: ui.statusbar.showMessage("Exported " + describe(stats)))
+        self.export_task.failed.connect(lambda error: ui.statusbar.showMessage("Could not export: " + str(error)))
+        self.export_task.start()
 
     def adjust_title(self):
         title = "PyEditPDF"
 
-        if self.path is not None:
-            title += " - " + os.path.basename(self.path)
+        if self.document.path is not None:
+            title += " - " + os.path.basename(self.document.path)
 
             if not self.saved:
                 title += "*"
 
         MainWindow.setWindowTitle(title)
 
-    def page_to_img(self, page):
-        canvas = Canvas("temp.pdf")
-        xobj = pagexobj(page)
-        canvas.setPageSize((xobj.BBox[2], xobj.BBox[3]))
-        canvas.saveState()
-        canvas.doForm(makerl(canvas, xobj))
-        canvas.restoreState()
-        canvas.showPage()
-        image = convert_from_bytes(canvas.getpdfdata())[0]
-        return image
-
-    def crop_page(self, page, rect):
-        page = PageMerge().add(page, viewrect=rect)
-        return page.render()
-
-    def adjust_page(self, page, margin=0, scale=1):  # todo: change margin to 4-tuple
-        info = PageMerge().add(page)
-        x1, y1, x2, y2 = info.xobj_box
-        viewrect = (margin, margin, x2 - x1 - 2 * margin, y2 - y1 - 2 * margin) # todo: change margin to 4-tuple
-        page = PageMerge().add(page, viewrect=viewrect)
-        page[0].scale(scale)
-        return page.render()
+    def render_key(self, page_no, kind):
+        # renders are cached by content, so duplicated pages and pages edited back to an earlier state share them
+        page = self.document.pages[page_no]
+        dpi = THUMBNAIL_DPI if kind == "thumb" else preview_dpi(page.size)
+        return page.fingerprint, kind, dpi
+
+    def source_of(self, page_no):
+        return self.document.source(page_no)
+
+    def invalidate_renders(self, rows):
+        for page_no in rows:
+            self.scheduler.cancel(("thumb", page_no))
+            self.scheduler.cancel(("preview", page_no))
+            # a batch already running still renders the old page, the new one is requested on its own
+            self.batched.pop(page_no, None)
+        ui.pageModel.invalidate(rows)
+
+    def request_preview(self, page_no, priority=PRIORITY_CURRENT):
+        key = ("preview", page_no)
+        cache_key = self.render_key(page_no, "preview")
+        if cache_key in self.render_cache:
+            # renders are cached by content, an edit can land on a page that was rendered before
+            if page_no == self.current_page:
+                ui.previewArea.load_from_pil(self.render_cache.get(cache_key))
+            return
+        if self.scheduler.is_scheduled(key):
+            self.scheduler.promote(key, priority)
+        else:
+            source = self.source_of(page_no)
+            self.scheduler.submit(key, self.render_page, page_no, self.document.pages[page_no], source,
+                                  self.document.source_stat(source), cache_key, priority=priority)
+
+    def request_thumbnail(self, page_no, priority):
+        key = ("thumb", page_no)
+        cache_key = self.render_key(page_no, "thumb")
+        if cache_key in self.render_cache:
+            return
+        batch = self.batch_of(page_no)
+        if batch is not None:
+            self.scheduler.promote(batch, priority)
+        elif self.scheduler.is_scheduled(key):
+            self.scheduler.promote(key, priority)
+        elif self.source_of(page_no) is not None:
+            # unedited pages are collected and rasterized straight from their file in as few poppler runs as possible
+            if not self.batch_requests:
+                QtCore.QTimer.singleShot(0, self.flush_batch_requests)
+            self.batch_requests[page_no] = min(priority, self.batch_requests.get(page_no, priority))
+        else:
+            self.scheduler.submit(key, self.render_page, page_no, self.document.pages[page_no], None, None, cache_key,
+                                  priority=priority)
+
+    def flush_batch_requests(self):
+        sources = {row: self.source_of(row) for row in self.batch_requests if row < len(self.document.pages)}
+        rows = [row for row, source in sources.items()
+                if source is not None and self.batch_of(row) is None and not self.scheduler.is_scheduled(("thumb", row))
+                and self.render_key(row, "thumb") not in self.render_cache]
+
+        for run in contiguous_runs(rows, sources, self.BATCH_SIZE):
+            key = ("batch", run[0], run[-1])
+            for row in run:
+                self.batched[row] = key, self.document.pages[row]
+            self.scheduler.submit(key, self.render_batch, run, [self.document.pages[row] for row in run],
+                                  [self.render_key(row, "thumb") for row in run], sources[run[0]],
+                                  self.document.source_stat(sources[run[0]]), priority=min(self.batch_requests[row] for row in run))
+
+        self.batch_requests.clear()
+
+    def batch_of(self, page_no):
+        # the batch rendering this row's thumbnail, unless the page was replaced since it was batched
+        key, page = self.batched.get(page_no, (None, None))
+        return key if page is self.document.pages[page_no] else None
+
+    def release_batch(self, key):
+        if key[0] == "batch":
+            for row in range(key[1], key[2] + 1):
+                if self.batched.get(row, (None, None))[0] == key:
+                    del self.batched[row]
+
+    def cancel_renders(self):
+        self.scheduler.cancel_all()
+        self.batch_requests.clear()
+        self.batched.clear()
+        self.tile_jobs.clear()
+
+    # render_page, render_batch and render_tile run on worker threads
+    def render_page(self, page_no, page, source, stat, cache_key):
+        dpi = cache_key[2]
+        if source is not None:
+            image = render_range(source[0], source[1], source[1], dpi)[0]
+            # a save can replace the file while it is rendered, its pages may have moved since the job was queued
+            if file_stat(source[0]) != stat:
+                source = None
+            elif cache_key[1] == "thumb" and source[2] is not None:
+                self.disk_cache.put(source[2], source[1], dpi, image)
+        if source is None:
+            image = page_to_img(page.flatten(), dpi)
+        return [(page_no, page, cache_key, image)]
+
+    def render_batch(self, rows, pages, cache_keys, first_source, stat):
+        path, first, digest = first_source
+        dpi = cache_keys[0][2]
+        images = render_range(path, first, first + len(rows) - 1, dpi)
+        if file_stat(path) != stat:
+            # see render_page
+            return [(row, page, cache_key, page_to_img(page.flatten(), dpi))
+                    for row, page, cache_key in zip(rows, pages, cache_keys)]
+        if digest is not None:
+            for i, image in enumerate(images):
+                self.disk_cache.put(digest, first + i, dpi, image)
+        return list(zip(rows, pages, cache_keys, images))
+
+    def render_tile(self, page_no, page, tile, dpi):
+        x, y, w, h = tile
+        return [(page_no, page, None, page_to_img(page.cropped((x, y, x + w, y + h)).flatten(), dpi))]
+
+    def handle_digest(self, document, file, stat, digest):
+        if digest is not None and document is self.document and file_stat(file) == stat:
+            document.set_digest(file, digest)
 
     def open_pdf(self, file):
         self.reset()
@@ -259,43 +606,137 @@ class Controller:
 
     def add_pdf(self, file):
 
-        if self.path is None:
-            self.path = file
-            self.adjust_title()
-
-        raw_pages = PdfReader(file).pages
-        for page in raw_pages:
-
-            result = PageMerge()
-            result.add(page)
-            page = result.render()
-
-            self.pages.append(page)
-            render = self.page_to_img(page)
-            self.renders.append(render)
-
-            new_item = QListWidgetItem()
-            ui.pageScrollArea.addItem(new_item)
-            page_label = PageLabel(render)
-            ui.pageScrollArea.setItemWidget(new_item, page_label)
+        stat = file_stat(file)
+        if stat[0] <= self.INLINE_DIGEST_SIZE:
+            count = self.document.add(file, file_digest(file))
+        else:
+            # the disk cache is skipped for the pages of this file until its hash is known
+            count = self.document.add(file)
+            task = BackgroundTask(lambda progress: hash_unchanged(file, stat), parent=MainWindow)
+            document = self.document
+            task.finished.connect(lambda digest: self.handle_digest(document, file, stat, digest))
+            task.start()
+        self.pages_added(count)
+
+    def open_pdfs(self, files):
+        if len(files) == 1:
+            self.open_pdf(files[0])
+            return
+        if self.import_task is not None and self.import_task.is_running():
+            ui.statusbar.showMessage("Still importing, try again once the current files are done")
+            return
+        self.reset()
+        self.add_pdfs(files, opened=True)
+
+    def add_pdfs(self, files, opened=False):
+        # many files are parsed and pre-rendered in parallel and appended in the order they were selected
+        if self.import_task is not None and self.import_task.is_running():
+            ui.statusbar.showMessage("Still importing, try again once the current files are done")
+            return
+
+        document = self.document
+        self.import_task = BackgroundTask(read_files, files, parent=MainWindow)
+        self.import_task.progress.connect(
+            lambda stage, done, total: ui.statusbar.showMessage(
+                "Importing: " + str(done) + " / " + str(total) + " files, " + stage))
+        self.import_task.finished.connect(lambda results: self.handle_import_finished(document, results, opened))
+        self.import_task.failed.connect(lambda error: ui.statusbar.showMessage("Could not import: " + str(error)))
+        self.import_task.start()
+
+    def handle_import_finished(self, document, results, opened):
+        if document is not self.document:
+            # another document was opened in the meantime
+            return
+
+        failed = [os.path.basename(path) + ": " + str(error) for path, _, _, error in results if error is not None]
+        # files opened together are all part of opening the document, not edits that undo could take back
+        count = sum(document.add(path, digest, reader, record=not opened)
+                    for path, reader, digest, error in results if error is None)
+        if count:
+            self.pages_added(count)
+            if opened:
+                self.show_page(0)
+        if failed:
+            ui.statusbar.showMessage("Could not import " + ", ".join(failed))
+
+    def pages_added(self, count):
+        self.adjust_title()
 
-            page_label.actionEvent.connect(self.handle_action)
+        # thumbnails are rendered on demand once their rows become visible
+        ui.pageModel.append_pages(count)
 
         ui.actionSave.setEnabled(True)
         ui.actionSaveAs.setEnabled(True)
+        ui.actionExportImages.setEnabled(True)
+        ui.actionSplit.setEnabled(True)
         ui.actionAddPages.setEnabled(True)
         ui.actionEditMeta.setEnabled(True)
 
         self.set_saved(False)
 
 
+def hash_unchanged(path, stat):
+    # runs on a worker thread; a file that was saved over while it was hashed has no valid hash
+    digest = file_digest(path)
+    return digest if file_stat(path) == stat else None
+
+
 def open_pdf():
     dlg = QFileDialog()
     dlg.setNameFilter("PDF files (*.pdf)")
+    dlg.setFileMode(QFileDialog.ExistingFiles)
     if dlg.exec_():
         filenames = dlg.selectedFiles()
-        for file in filenames:
-            controller.open_pdf(file)
+        controller.open_pdfs(filenames)
+
+
+def add_pdf():
+    dlg = QFileDialog()
+    dlg.setNameFilter("PDF files (*.pdf)")
+    dlg.setFileMode(QFileDialog.ExistingFiles)
+    if dlg.exec_():
+        controller.add_pdfs(dlg.selectedFiles())
+
+
+def save_pdf_as():
+    file, _ = QFileDialog.getSaveFileName(MainWindow, filter="PDF files (*.pdf)")
+    if file:
+        controller.save(file)
+
+
+def export_images_dialog():
+    folder = QFileDialog.getExistingDirectory(MainWindow, "Export Images")
+    if not folder:
+        return
+    dpi, ok = QtWidgets.QInputDialog.getInt(MainWindow, "Export Images", "Resolution (dpi):", DEFAULT_DPI, 10, 1200)
+    if not ok:
+        return
+    image_format, ok = QtWidgets.QInputDialog.getItem(MainWindow, "Export Images", "Format:", IMAGE_FORMATS, 0, False)
+    if ok:
+        controller.export_images(folder, dpi, image_format)
+
+
+def split_pdf_dialog():
+    count = len(controller.document.pages)
+    text, ok = QtWidgets.QInputDialog.getText(MainWindow, "Split PDF",
+                                              "Page ranges, e.g. 1-3,4-10 (empty for one file per page):")
+    if not ok:
+        return
+    try:
+        ranges = page_ranges(text, count) if text.strip() else [range(row, row + 1) for row in range(count)]
+    except ValueError as error:
+        ui.statusbar.showMessage("Could not split: " + str(error))
+        return
+    folder = QFileDialog.getExistingDirectory(MainWindow, "Split PDF")
+    if folder:
+        controller.split_pdf(folder, ranges)
+
+
+def preload():
+    # the rendering backends and numpy are imported on first use; once the window is painted a worker thread loads
+    # them, so that opening the first file does not wait for them either
+    with span("preload"):
+        import numpy, pdf2image, pdfrw.toreportlab, reportlab.pdfgen.canvas, PIL.Image  # noqa: F401
 
 
 if __name__ == "__main__":
@@ -306,5 +747,7 @@ if __name__ == "__main__":
     ui.setupUi(MainWindow)
 
     controller = Controller()
+    first_paint = FirstPaint(MainWindow)
+    first_paint.painted.connect(lambda: threading.Thread(target=preload, name="preload", daemon=True).start())
     MainWindow.show()
     sys.exit(app.exec_())
@@ -0,0 +1,67 @@
+import os
+import random
+
+from PIL import Image
+from reportlab.lib.pagesizes import A0, A4
+from reportlab.lib.utils import ImageReader
+from reportlab.pdfgen.canvas import Canvas
+
+# kind -> (page size, pages per requested document size)
+KINDS = {
+    "text": (A4, 1),
+    "image": (A4, 1),
+    "many": (A4, 10),
+    "large": (A0, 1),
+}
+
+_WORDS = ("lorem ipsum dolor sit amet consectetur adipiscing elit sed do eiusmod tempor incididunt ut labore et "
+          "dolore magna aliqua").split()
+
+
+def _text_page(canvas, rng, width, height, lines):
+    text = canvas.beginText(40, height - 50)
+    text.setFont("Helvetica", 10)
+    for _ in range(lines):
+        text.textLine(" ".join(rng.choice(_WORDS) for _ in range(14)))
+    canvas.drawText(text)
+
+
+def _image_page(canvas, rng, width, height):
+    # noise does not compress, like the scans that make up most image-heavy documents
+    image = Image.frombytes("RGB", (300, 400), rng.randbytes(300 * 400 * 3))
+    canvas.drawImage(ImageReader(image), 40, 40, width - 80, height - 80)
+
+
+def _drawing_page(canvas, rng, width, height):
+    canvas.setLineWidth(0.5)
+    for _ in range(2000):
+        canvas.line(rng.uniform(0, width), rng.uniform(0, height), rng.uniform(0, width), rng.uniform(0, height))
+    _text_page(canvas, rng, width, height, 20)
+
+
+def generate(kind, size, path):
+    # the same kind and size always produce the same file, so results of different runs are comparable
+    pagesize, factor = KINDS[kind]
+    width, height = pagesize
+    rng = random.Random("%s-%d" % (kind, size))
+    canvas = Canvas(path, pagesize=pagesize, invariant=1)
+    for _ in range(size * factor):
+        if kind == "text":
+            _text_page(canvas, rng, width, height, 70)
+        elif kind == "image":
+            _image_page(canvas, rng, width, height)
+        elif kind == "many":
+            _text_page(canvas, rng, width, height, 1)
+        else:
+            _drawing_page(canvas, rng, width, height)
+        canvas.showPage()
+    canvas.save()
+
+
+def document_path(folder, kind, size):
+    path = os.path.join(folder, "%s-%d.pdf" % (kind, size))
+    if not os.path.exists(path):
+        os.makedirs(folder, exist_ok=True)
+        generate(kind, size, path + ".tmp")
+        os.replace(path + ".tmp", path)
+    return path
@@ -0,0 +1,16 @@
+import sys
+
+
+def peak_rss():
+    # on Linux ru_maxrss survives the exec of a spawned process and would include the parent's peak
+    try:
+        with open("/proc/self/status") as f:
+            for line in f:
+                if line.startswith("VmHWM:"):
+                    return int(line.split()[1]) * 1024
+    except OSError:
+        pass
+    import resource
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # kilobytes on Linux, bytes on macOS
+    return peak * 1024 if sys.platform != "darwin" else peak
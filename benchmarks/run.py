@@ -0,0 +1,277 @@
+import argparse
+import gc
+import json
+import multiprocessing
+import os
+import platform
+import shutil
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from documents import KINDS, document_path  # noqa: E402
+from memory import peak_rss  # noqa: E402
+
+DEFAULT_DATA_DIR = os.path.join(tempfile.gettempdir(), "pyeditpdf-benchmarks")
+
+
+# Each benchmark takes the path of a generated document and a scratch folder, does its untimed setup and returns the
+# function to time. Setup runs again before every repetition, so edits and caches never carry over.
+
+def bench_open(path, scratch):
+    from document import Document
+    return lambda: Document(path)
+
+
+def bench_render(path, scratch):
+    # edited pages go through reportlab and poppler, the first few pages at preview resolution
+    from document import Document
+    from render import page_to_img, preview_dpi
+    document = Document(path)
+    pages = document.pages[:5]
+
+    def run():
+        for page in pages:
+            page_to_img(page.flatten(), preview_dpi(page.size))
+    return run
+
+
+def bench_render_range(path, scratch):
+    # unedited pages are rasterized straight from the file, all thumbnails in one poppler run
+    from document import Document
+    from render import render_range, THUMBNAIL_DPI
+    count = len(Document(path))
+    return lambda: render_range(path, 0, count - 1, THUMBNAIL_DPI)
+
+
+def bench_crop(path, scratch):
+    from document import Document
+    document = Document(path)
+
+    def run():
+        document.crop(range(len(document)), (0.1, 0.1, 0.9, 0.9))
+        for page in document.pages:
+            page.flatten()
+    return run
+
+
+def bench_rotate(path, scratch):
+    from document import Document
+    document = Document(path)
+
+    def run():
+        document.rotate(range(len(document)), 90)
+        for page in document.pages:
+            page.flatten()
+    return run
+
+
+def bench_pil2pixmap(path, scratch):
+    # a preview sized bitmap of each of the first pages, as handed to the view
+    os.environ.setdefault("QT_QPA_PLATFORM", "offscreen")
+    from PIL import Image
+    from PyQt5 import QtWidgets
+    from document import Document
+    from render import preview_dpi
+    from widgets import pil2pixmap
+    global _app
+    _app = QtWidgets.QApplication.instance() or QtWidgets.QApplication([])
+
+    images = list()
+    for page in Document(path).pages[:5]:
+        width, height = page.size
+        dpi = preview_dpi(page.size)
+        images.append(Image.effect_noise((int(width * dpi / 72), int(height * dpi / 72)), 64).convert("RGB"))
+
+    def run():
+        for image in images:
+            pil2pixmap(image)
+    return run
+
+
+def bench_save(path, scratch):
+    from document import Document
+    document = Document(path)
+    document.rotate([0], 90)
+    return lambda: document.save(os.path.join(scratch, "saved.pdf"))
+
+
+def bench_save_incremental(path, scratch):
+    copy = os.path.join(scratch, "incremental.pdf")
+    shutil.copy(path, copy)
+    from document import Document
+    document = Document(copy)
+    document.rotate([0], 90)
+    return lambda: document.save()
+
+
+def bench_startup(path, scratch):
+    # a fresh interpreter from its launch until the editor's window is first painted
+    script = os.path.join(os.path.dirname(os.path.abspath(__file__)), "startup.py")
+
+    def run():
+        output = subprocess.run([sys.executable, script, repr(time.time())], stdout=subprocess.PIPE,
+                                stderr=subprocess.DEVNULL, universal_newlines=True, timeout=60).stdout
+        seconds, peak = output.split()[:2]
+        return float(seconds), int(peak)
+    return run
+
+
+BENCHMARKS = {
+    "startup": bench_startup,
+    "open": bench_open,
+    "render": bench_render,
+    "render_range": bench_render_range,
+    "crop": bench_crop,
+    "rotate": bench_rotate,
+    "pil2pixmap": bench_pil2pixmap,
+    "save": bench_save,
+    "save_incremental": bench_save_incremental,
+}
+
+# these do not use the documents and run once per suite. They time something in another process and return the
+# seconds and peak memory measured there.
+STANDALONE = {"startup"}
+
+
+def _measure(name, path, repeat, queue):
+    # runs in a fresh process, so the peak memory belongs to this benchmark alone
+    try:
+        times = list()
+        peaks = list()
+        with tempfile.TemporaryDirectory() as scratch:
+            for _ in range(repeat):
+                run = BENCHMARKS[name](path, scratch)
+                gc.collect()
+                if name in STANDALONE:
+                    seconds, peak = run()
+                    times.append(seconds)
+                    peaks.append(peak)
+                    continue
+                start = time.perf_counter()
+                run()
+                times.append(time.perf_counter() - start)
+        queue.put({"times": times, "peak_rss": max(peaks) if peaks else peak_rss()})
+    except Exception as error:
+        queue.put({"error": type(error).__name__ + ": " + str(error)})
+
+
+def measure(name, path, repeat):
+    context = multiprocessing.get_context("spawn")
+    queue = context.Queue()
+    process = context.Process(target=_measure, args=(name, path, repeat, queue))
+    process.start()
+    result = queue.get()
+    process.join()
+    return result
+
+
+def _record(results, name, path, repeat, entry):
+    result = measure(name, path, repeat)
+    if "error" in result:
+        entry["error"] = result["error"]
+    else:
+        entry.update(wall_median=statistics.median(result["times"]), wall_min=min(result["times"]),
+                     runs=result["times"], peak_rss=result["peak_rss"])
+    results.append(entry)
+    report(entry)
+
+
+def run_suite(benchmarks, kinds, sizes, repeat, data_dir):
+    results = list()
+    for name in benchmarks:
+        if name in STANDALONE:
+            _record(results, name, None, repeat,
+                    {"benchmark": name, "document": "-", "size": 0, "pages": 0, "file_size": 0})
+    for kind in kinds:
+        for size in sizes:
+            path = document_path(data_dir, kind, size)
+            for name in benchmarks:
+                if name not in STANDALONE:
+                    _record(results, name, path, repeat,
+                            {"benchmark": name, "document": kind, "size": size, "pages": size * KINDS[kind][1],
+                             "file_size": os.path.getsize(path)})
+    return results
+
+
+def _key(entry):
+    return entry["benchmark"], entry["document"], entry["size"]
+
+
+def report(entry, baseline=None):
+    label = "%-17s %-6s %5d" % _key(entry)
+    if "error" in entry:
+        print(label + "  failed: " + entry["error"])
+        return
+    line = label + "  %9.1f ms  %7.1f MB" % (entry["wall_median"] * 1000, entry["peak_rss"] / 2 ** 20)
+    if baseline is not None and "wall_median" in baseline:
+        line += "  x%.2f time  x%.2f memory" % (entry["wall_median"] / max(baseline["wall_median"], 1e-9),
+                                               entry["peak_rss"] / max(baseline["peak_rss"], 1))
+    print(line)
+
+
+def compare(results, baseline_path, threshold):
+    # returns the number of benchmarks that got slower than the baseline by more than the threshold
+    with open(baseline_path) as f:
+        baseline = {_key(entry): entry for entry in json.load(f)["results"]}
+    print("\nCompared to " + baseline_path)
+    regressions = 0
+    for entry in results:
+        old = baseline.get(_key(entry))
+        if old is None or "wall_median" not in entry:
+            continue
+        report(entry, old)
+        if "wall_median" in old and entry["wall_median"] > old["wall_median"] * threshold:
+            regressions += 1
+    return regressions
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description="Time opening, rendering, editing and saving synthetic documents.")
+    parser.add_argument("--benchmarks", default=",".join(BENCHMARKS), help="comma separated, default: all")
+    parser.add_argument("--kinds", default=",".join(KINDS), help="documents to generate, default: all")
+    parser.add_argument("--sizes", default="10,100", help="document sizes in pages, default: 10,100")
+    parser.add_argument("--repeat", type=int, default=3, help="repetitions per benchmark, the median is reported")
+    parser.add_argument("--data", default=DEFAULT_DATA_DIR, help="folder for the generated documents")
+    parser.add_argument("-o", "--output", help="write the results to this json file")
+    parser.add_argument("--baseline", help="json file of an earlier run to compare with")
+    parser.add_argument("--threshold", type=float, default=1.2,
+                        help="slowdown against the baseline that counts as a regression, default: 1.2")
+    return parser.parse_args(argv)
+
+
+def main(argv=None):
+    args = parse_args(argv)
+    benchmarks = args.benchmarks.split(",")
+    kinds = args.kinds.split(",")
+    unknown = [name for name in benchmarks if name not in BENCHMARKS] + [kind for kind in kinds if kind not in KINDS]
+    if unknown:
+        print("Unknown benchmark or document kind: " + ", ".join(unknown), file=sys.stderr)
+        return 2
+
+    results = run_suite(benchmarks, kinds, [int(size) for size in args.sizes.split(",")], args.repeat, args.data)
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump({
+                "created": time.strftime("%Y-%m-%dT%H:%M:%S"),
+                "python": platform.python_version(),
+                "platform": platform.platform(),
+                "cpu_count": os.cpu_count(),
+                "repeat": args.repeat,
+                "results": results,
+            }, f, indent=1)
+
+    if args.baseline:
+        regressions = compare(results, args.baseline, args.threshold)
+        if regressions:
+            print(str(regressions) + " benchmark(s) slower than the baseline by more than x%.2f" % args.threshold)
+            return 1
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,38 @@
+import os
+import runpy
+import sys
+import time
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+
+# Started by the startup benchmark with the time.time() of its launch as the only argument. Runs app.py as it is
+# started by users, prints the seconds from the launch until the main window is first painted and the peak memory of
+# the process by then, and quits.
+
+def main():
+    launched = float(sys.argv[1])
+    os.environ.setdefault("QT_QPA_PLATFORM", "offscreen")
+    sys.path.insert(0, ROOT)
+    from PyQt5 import QtWidgets
+    from memory import peak_rss
+    import widgets
+
+    def report():
+        seconds = time.time() - launched
+        print(seconds, peak_rss(), flush=True)
+        QtWidgets.QApplication.instance().quit()
+
+    watch = widgets.FirstPaint.__init__
+
+    def __init__(self, widget):
+        watch(self, widget)
+        self.painted.connect(report)
+
+    widgets.FirstPaint.__init__ = __init__
+    sys.argv = [os.path.join(ROOT, "app.py")]
+    runpy.run_path(sys.argv[0], run_name="__main__")
+
+
+if __name__ == "__main__":
+    main()
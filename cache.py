@@ -0,0 +1,176 @@
+import hashlib
+import mmap
+import os
+import threading
+from collections import OrderedDict
+
+from instrument import count, span
+
+DEFAULT_BUDGET = int(os.environ.get("PYEDITPDF_RENDER_CACHE_MB", 512)) * 2 ** 20
+
+DEFAULT_DISK_CACHE_DIR = os.path.join(os.environ.get("XDG_CACHE_HOME", os.path.expanduser("~/.cache")),
+                                      "pyeditpdf", "thumbnails")
+DEFAULT_DISK_BUDGET = int(os.environ.get("PYEDITPDF_DISK_CACHE_MB", 256)) * 2 ** 20
+
+
+def image_nbytes(image):
+    return image.width * image.height * len(image.getbands())
+
+
+class RenderCache:
+
+    def __init__(self, budget=DEFAULT_BUDGET):
+        self.budget = budget
+        self.size = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def __contains__(self, key):
+        return key in self._entries
+
+    def __len__(self):
+        return len(self._entries)
+
+    def get(self, key):
+        with self._lock:
+            image = self._entries.get(key)
+            if image is None:
+                self.misses += 1
+                count("render cache misses")
+                return None
+            self._entries.move_to_end(key)
+            self.hits += 1
+            count("render cache hits")
+            return image
+
+    def put(self, key, image):
+        nbytes = image_nbytes(image)
+        if nbytes > self.budget:
+            return
+        with self._lock:
+            old = self._entries.pop(key, None)
+            if old is not None:
+                self.size -= image_nbytes(old)
+            self._entries[key] = image
+            self.size += nbytes
+            while self.size > self.budget:
+                _, evicted = self._entries.popitem(last=False)
+                self.size -= image_nbytes(evicted)
+                self.evictions += 1
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self.size = 0
+
+    def stats(self):
+        lookups = self.hits + self.misses
+        return {
+            "entries": len(self._entries),
+            "size": self.size,
+            "budget": self.budget,
+            "hits": self.hits,
+            "misses": self.misses,
+            "evictions": self.evictions,
+            "hit_rate": self.hits / lookups if lookups else 0.0,
+        }
+
+    def describe(self):
+        # what it takes to tune the budget, short enough for a status bar
+        stats = self.stats()
+        return "render cache %.0f / %.0f MB, %d entries, %.0f%% hits, %d evictions" % (
+            stats["size"] / 2 ** 20, stats["budget"] / 2 ** 20, stats["entries"], stats["hit_rate"] * 100,
+            stats["evictions"])
+
+
+def file_stat(path):
+    # changes whenever the file is written to
+    stat = os.stat(path)
+    return stat.st_size, stat.st_mtime_ns
+
+
+def file_digest(path):
+    with open(path, "rb") as f:
+        if os.fstat(f.fileno()).st_size == 0:
+            return hashlib.sha1().hexdigest()
+        # hashing the mapped file needs no buffer of its own and runs without holding the GIL
+        with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as data, span("hash", path=path):
+            return hashlib.sha1(data).hexdigest()
+
+
+# Thumbnails of unedited pages, kept as png files between sessions and keyed by the content hash of their pdf. The
+# modification time of a file doubles as its last use, the least recently used files go once the budget is exceeded.
+class ThumbnailDiskCache:
+
+    def __init__(self, root=DEFAULT_DISK_CACHE_DIR, budget=DEFAULT_DISK_BUDGET):
+        self.root = root
+        self.budget = budget
+        self._size = None
+        self._lock = threading.Lock()
+
+    def _path(self, digest, page_index, dpi):
+        return os.path.join(self.root, digest[:2], digest, "%d_%d.png" % (page_index, dpi))
+
+    def get(self, digest, page_index, dpi):
+        from PIL import Image
+        path = self._path(digest, page_index, dpi)
+        try:
+            image = Image.open(path)
+            image.load()
+            os.utime(path)
+        except (OSError, ValueError):
+            count("disk cache misses")
+            return None
+        count("disk cache hits")
+        return image
+
+    def put(self, digest, page_index, dpi, image):
+        # the cache is best effort, a read-only or full disk only means thumbnails are rendered again
+        path = self._path(digest, page_index, dpi)
+        # import workers fill the cache from several processes
+        temp_path = path + ".%d.%d.tmp" % (os.getpid(), threading.get_ident())
+        try:
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            image.save(temp_path, "PNG")
+            os.replace(temp_path, path)
+            size = os.path.getsize(path)
+        except OSError:
+            return
+
+        with self._lock:
+            if self._size is None:
+                self._size = sum(entry[1] for entry in self._entries())
+            else:
+                self._size += size
+            if self._size > self.budget:
+                self._evict()
+
+    def _entries(self):
+        entries = list()
+        for folder, _, files in os.walk(self.root):
+            for name in files:
+                path = os.path.join(folder, name)
+                try:
+                    stat = os.stat(path)
+                except OSError:
+                    continue
+                entries.append((stat.st_mtime, stat.st_size, path))
+        return entries
+
+    def _evict(self):
+        entries = sorted(self._entries())
+        size = sum(entry[1] for entry in entries)
+        # evict a little more than needed so that not every write walks the cache folder
+        target = self.budget * 0.9
+        for _, entry_size, path in entries:
+            if size <= target:
+                break
+            try:
+                os.remove(path)
+            except OSError:
+                continue
+            size -= entry_size
+        self._size = size
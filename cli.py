@@ -0,0 +1,129 @@
+import argparse
+import os
+import sys
+import time
+from concurrent.futures import ProcessPoolExecutor, as_completed
+
+from document import Document
+from export import page_ranges
+
+
+def parse_ranges(text, count):
+    # "1-3,7" -> [0, 1, 2, 6]
+    return [row for part in page_ranges(text, count) for row in part]
+
+
+def parse_selection(text):
+    selection = tuple(float(x) for x in text.split(","))
+    if len(selection) != 4:
+        raise argparse.ArgumentTypeError("expected x1,y1,x2,y2")
+    return selection
+
+
+def parse_margin(text):
+    margin = tuple(float(x) for x in text.split(","))
+    if len(margin) == 1:
+        return margin[0]
+    if len(margin) != 4:
+        raise argparse.ArgumentTypeError("expected one margin or left,top,right,bottom")
+    return margin
+
+
+def apply_edits(document, args):
+    # crops are given in fractions of the pages as they are in the input, so they are applied before rotating
+    rows = parse_ranges(args.pages, len(document)) if args.pages else range(len(document))
+    if args.crop:
+        document.crop(rows, args.crop)
+    if args.margin or args.scale != 1:
+        document.adjust(rows, args.margin, args.scale)
+    if args.rotate:
+        document.rotate(rows, args.rotate)
+    if args.delete:
+        document.delete(parse_ranges(args.delete, len(document)))
+
+
+def process_file(path, output, args):
+    # runs in a worker process
+    start = time.perf_counter()
+    document = Document(path)
+    apply_edits(document, args)
+    document.save(output, optimize=args.optimize)
+    return len(document), time.perf_counter() - start
+
+
+def merge_files(args):
+    start = time.perf_counter()
+    document = Document()
+    try:
+        for path in args.inputs:
+            document.add(path)
+        apply_edits(document, args)
+        document.save(args.merge, optimize=args.optimize)
+    except Exception as error:
+        print(args.merge + ": " + str(error), file=sys.stderr)
+        return 1
+    print(args.merge + ": " + str(len(document)) + " pages in %.2f s" % (time.perf_counter() - start))
+    return 0
+
+
+def process_files(args):
+    if args.in_place:
+        outputs = list(args.inputs)
+    else:
+        outputs = [os.path.join(args.output, os.path.basename(path)) for path in args.inputs]
+        if len(set(outputs)) != len(outputs):
+            print("Inputs with the same file name would overwrite each other in " + args.output, file=sys.stderr)
+            return 2
+        os.makedirs(args.output, exist_ok=True)
+
+    start = time.perf_counter()
+    failed = 0
+    pages = 0
+    with ProcessPoolExecutor(max_workers=args.jobs) as pool:
+        futures = {pool.submit(process_file, path, output, args): output for path, output in zip(args.inputs, outputs)}
+        for future in as_completed(futures):
+            try:
+                count, seconds = future.result()
+            except Exception as error:
+                failed += 1
+                print(futures[future] + ": " + str(error), file=sys.stderr)
+                continue
+            pages += count
+            print(futures[future] + ": " + str(count) + " pages in %.2f s" % seconds)
+
+    elapsed = time.perf_counter() - start
+    print("Processed " + str(len(outputs) - failed) + " / " + str(len(outputs)) + " files, " + str(pages)
+          + " pages in %.2f s" % elapsed)
+    return 1 if failed else 0
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description="Edit many PDF files without opening the editor.")
+    parser.add_argument("inputs", nargs="+", help="PDF files to process")
+    target = parser.add_mutually_exclusive_group(required=True)
+    target.add_argument("-o", "--output", help="folder to write the edited files to")
+    target.add_argument("--in-place", action="store_true", help="save the edits back into the input files")
+    target.add_argument("--merge", metavar="FILE", help="concatenate all inputs into one file")
+    parser.add_argument("--pages", help="pages to crop, adjust and rotate, e.g. 1-3,7 (default: all)")
+    parser.add_argument("--crop", type=parse_selection, metavar="X1,Y1,X2,Y2",
+                        help="keep this part of the pages, in fractions of the page from the top left")
+    parser.add_argument("--margin", type=parse_margin, default=0,
+                        help="points to cut from every side, or left,top,right,bottom")
+    parser.add_argument("--scale", type=float, default=1, help="scale the pages by this factor")
+    parser.add_argument("--rotate", type=int, default=0, choices=(0, 90, 180, 270), help="rotate clockwise")
+    parser.add_argument("--delete", help="pages to remove, e.g. 2,4-5")
+    parser.add_argument("--no-optimize", dest="optimize", action="store_false",
+                        help="neither share identical resources nor compress streams")
+    parser.add_argument("-j", "--jobs", type=int, default=os.cpu_count(), help="worker processes")
+    return parser.parse_args(argv)
+
+
+def main(argv=None):
+    args = parse_args(argv)
+    if args.merge:
+        return merge_files(args)
+    return process_files(args)
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,20 @@
+import pytest
+from pdfrw import IndirectPdfDict, PdfDict, PdfName, PdfWriter
+
+
+def write_pages(path, count):
+    # page i is 100 + i points wide, which tells the pages apart after they were moved around. Every page has a font
+    # object of its own with the same content, as after merging files, for deduplication to find.
+    writer = PdfWriter()
+    for i in range(count):
+        contents = PdfDict(stream="BT /F1 12 Tf (%d) Tj ET" % i)
+        font = IndirectPdfDict(Type=PdfName.Font, Subtype=PdfName.Type1, BaseFont=PdfName.Helvetica)
+        writer.addpage(PdfDict(Type=PdfName.Page, MediaBox=[0, 0, 100 + i, 200], Contents=contents,
+                               Resources=PdfDict(Font=PdfDict(F1=font))))
+    writer.write(str(path))
+    return str(path)
+
+
+@pytest.fixture
+def make_pdf(tmp_path):
+    return lambda count=4, name="pages.pdf": write_pages(tmp_path / name, count)
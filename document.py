@@ -0,0 +1,251 @@
+import itertools
+import mmap
+import os
+import sys
+from collections import deque
+
+from pdfrw import PdfReader
+
+from cache import file_digest, file_stat
+from instrument import count, span
+from pages import EditPage
+from writer import IncrementalBase, save_pdf
+
+
+HISTORY_BUDGET = int(os.environ.get("PYEDITPDF_UNDO_MB", 64)) * 2 ** 20
+# rough cost of an EditPage that only the history keeps alive, its source page is shared with the document and its
+# flattened copy is released
+_PAGE_COST = 512
+
+
+def read_pdf(path):
+    # pdfrw parses from a str of the whole file and resolves objects from it on first access. Decoding it straight
+    # from a mapping of the file instead of from a read() buffer halves the peak memory of opening a large file.
+    with open(path, "rb") as f:
+        if os.fstat(f.fileno()).st_size == 0:
+            return PdfReader(path)
+        with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as data:
+            return PdfReader(fdata=str(data, "latin-1"))
+
+
+def write_document(pages, path, base=None, optimize=True, progress=None):
+    # the part of saving that touches the disk, safe to run on any thread. Returns whether the save was incremental
+    # and the content hash of the file afterwards.
+    with span("save", path=path):
+        incremental = save_pdf(pages, path, base, optimize, progress)
+    # the content hash of a large file is not recomputed after appending a few objects to it, the disk cache is
+    # simply skipped for it until it is opened again
+    return incremental, None if incremental else file_digest(path)
+
+
+# Undo and redo stacks of edits. An edit is (kind, rows, before, after) with the pages it replaced and the pages it
+# put in their place, never a copy of the document, so all states share their unchanged pages and everything cached
+# on them. The oldest edits are dropped once the pages they keep alive exceed the budget.
+class History:
+
+    def __init__(self, budget=HISTORY_BUDGET):
+        self.budget = budget
+        self.size = 0
+        self._undo = deque()
+        self._redo = list()
+
+    @staticmethod
+    def _cost(edit):
+        _, rows, before, after = edit
+        return sys.getsizeof(rows) + (len(before) + len(after)) * _PAGE_COST
+
+    def can_undo(self):
+        return bool(self._undo)
+
+    def can_redo(self):
+        return bool(self._redo)
+
+    def record(self, edit):
+        for dropped in self._redo:
+            self.size -= self._cost(dropped)
+        self._redo.clear()
+        self._undo.append(edit)
+        self.size += self._cost(edit)
+        while self.size > self.budget and len(self._undo) > 1:
+            self.size -= self._cost(self._undo.popleft())
+
+    def undo(self):
+        edit = self._undo.pop()
+        self._redo.append(edit)
+        return edit
+
+    def redo(self):
+        edit = self._redo.pop()
+        self._undo.append(edit)
+        return edit
+
+    def pages(self):
+        # every page the edits keep alive, many of them also in the document
+        for _, _, before, after in itertools.chain(self._undo, self._redo):
+            yield from before
+            yield from after
+
+    def clear(self):
+        self._undo.clear()
+        self._redo.clear()
+        self.size = 0
+
+
+# The pages being edited and the file they are saved to, independent of any user interface. Edits replace pages in
+# the list with new EditPages, so a copy of the list is a consistent snapshot of the document.
+#
+# rows are 0-based page positions, selection is (x1, y1, x2, y2) in fractions of the page as displayed.
+class Document:
+
+    def __init__(self, path=None):
+        self.pages = list()
+        self.path = None
+        self.base = None
+        self.history = History()
+        # (size, mtime) of the files the origins of the pages refer to, by absolute path, as they were when the origins
+        # were last valid
+        self.file_stats = dict()
+        if path is not None:
+            self.add(path)
+
+    def __len__(self):
+        return len(self.pages)
+
+    def add(self, path, digest=None, reader=None, record=True):
+        # digest is the content hash of the file, which keys the thumbnail disk cache. Hashing reads the whole file,
+        # so it is left to the caller and can be filled in later with set_digest. A reader of the file may be passed
+        # in when it was parsed elsewhere. record=False adds the pages as part of opening the document, like its first
+        # file.
+        stat = file_stat(path)
+        if reader is None:
+            with span("parse", path=path):
+                reader = read_pdf(path)
+        self.file_stats[os.path.abspath(path)] = stat
+
+        if self.path is None:
+            self.path = path
+        if self.base is None and not self.pages:
+            # saving back to the file it was opened from only appends the changes
+            self.base = IncrementalBase(path, reader)
+
+        count("pages opened", len(reader.pages))
+        first = len(self.pages)
+        self.pages.extend(EditPage(page, origin=(path, i, digest)) for i, page in enumerate(reader.pages))
+        if first and record:
+            # opening a file is not an edit, adding pages to it is
+            self.history.record(("add", range(first, len(self.pages)), [], self.pages[first:]))
+        return len(reader.pages)
+
+    def source(self, row):
+        # unedited pages can be rasterized straight from the file they were loaded from, as (file, page index, digest)
+        page = self.pages[row]
+        return page.origin if page.unedited else None
+
+    def source_stat(self, source):
+        # what the file of a source should look like for its page index to be valid, see render_page
+        return None if source is None else self.file_stats.get(os.path.abspath(source[0]))
+
+    def set_digest(self, path, digest):
+        for page in self.pages:
+            if page.origin is not None and page.origin[0] == path and page.origin[2] is None:
+                page.origin = (path, page.origin[1], digest)
+
+    def _replace(self, kind, rows, edit):
+        rows = sorted(set(rows))
+        before = [self.pages[row] for row in rows]
+        after = [edit(row, page) for row, page in zip(rows, before)]
+        for row, page in zip(rows, after):
+            self.pages[row] = page
+        self.history.record((kind, rows, before, after))
+        self._release(before)
+
+    def rotate(self, rows, angle=90):
+        self._replace("rotate", rows, lambda row, page: page.rotated(angle))
+
+    def crop(self, rows, selection):
+        self._replace("crop", rows, lambda row, page: page.cropped(selection))
+
+    def crop_each(self, selections):
+        # selections maps rows to a selection of their own, all cropped as a single edit
+        self._replace("crop", selections, lambda row, page: page.cropped(selections[row]))
+
+    def adjust(self, rows, margin=0, scale=1):
+        self._replace("adjust", rows, lambda row, page: page.adjusted(margin, scale))
+
+    def delete(self, rows):
+        rows = sorted(set(rows))
+        before = [self.pages[row] for row in rows]
+        self.history.record(("delete", rows, before, []))
+        self._remove(rows)
+        self._release(before)
+
+    def _remove(self, rows):
+        rows = set(rows)
+        self.pages[:] = [page for row, page in enumerate(self.pages) if row not in rows]
+
+    def _release(self, pages):
+        # pages that left the document for the history, see _PAGE_COST
+        current = {id(page) for page in self.pages}
+        for page in pages:
+            if id(page) not in current:
+                page.release()
+
+    def _insert(self, rows, pages):
+        # rows are ascending positions in the resulting list
+        inserted = dict(zip(rows, pages))
+        remaining = iter(self.pages)
+        self.pages[:] = [inserted[row] if row in inserted else next(remaining)
+                         for row in range(len(self.pages) + len(inserted))]
+
+    def undo(self):
+        # returns the edit that was undone, (kind, rows, before, after), so a view can tell what to refresh
+        edit = self.history.undo()
+        kind, rows, before, after = edit
+        if kind == "delete":
+            self._insert(rows, before)
+        elif kind == "add":
+            del self.pages[rows[0]:]
+        else:
+            for row, page in zip(rows, before):
+                self.pages[row] = page
+        self._release(after)
+        return edit
+
+    def redo(self):
+        edit = self.history.redo()
+        kind, rows, before, after = edit
+        if kind == "delete":
+            self._remove(rows)
+        elif kind == "add":
+            self.pages.extend(after)
+        else:
+            for row, page in zip(rows, after):
+                self.pages[row] = page
+        self._release(before)
+        return edit
+
+    def save(self, path=None, optimize=True, progress=None):
+        if path is not None:
+            self.path = path
+        snapshot = list(self.pages)
+        _, digest = write_document(snapshot, self.path, self.base, optimize, progress)
+        self.saved(snapshot, digest)
+
+    def saved(self, snapshot, digest):
+        # pages are rasterized from the file they came from, which no longer has the same pages at the same places
+        # once it is saved over. The file now holds each unedited page of the snapshot at its position there. Pages
+        # that only the history keeps are remapped as well, undoing brings them back. Returns whether any page of the
+        # document changed its origin.
+        path = os.path.abspath(self.path)
+        self.file_stats[path] = file_stat(path)
+        positions = {id(page.source): (self.path, i, digest) for i, page in enumerate(snapshot) if page.unedited}
+        current = {id(page) for page in self.pages}
+
+        changed = False
+        for page in itertools.chain(self.pages, self.history.pages()):
+            origin = positions.get(id(page.source))
+            stale = page.origin is not None and os.path.abspath(page.origin[0]) == path
+            if (origin or stale) and origin != page.origin:
+                page.origin = origin
+                changed = changed or id(page) in current
+        return changed
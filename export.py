@@ -0,0 +1,85 @@
+import os
+import time
+from concurrent.futures import ThreadPoolExecutor, as_completed
+
+from instrument import count, no_progress, span
+from render import DEFAULT_DPI, page_to_img, render_range
+from writer import write_pdf
+
+IMAGE_FORMATS = ("png", "jpg", "tiff")
+
+
+def page_ranges(text, count):
+    # "1-3,7" -> [range(0, 3), range(6, 7)], page numbers are 1-based and inclusive like in any print dialog
+    ranges = list()
+    for part in text.split(","):
+        first, _, last = part.strip().partition("-")
+        first = int(first)
+        last = int(last) if last else first
+        if not 1 <= first <= last <= count:
+            raise ValueError("page range " + part.strip() + " is outside of 1-" + str(count))
+        ranges.append(range(first - 1, last))
+    return ranges
+
+
+def describe(stats):
+    seconds = max(stats["seconds"], 1e-9)
+    return (str(stats["files"]) + " files, " + str(stats["pages"]) + " pages, %.1f MB in %.1f s (%.1f pages/s, %.1f MB/s)"
+            % (stats["bytes"] / 2 ** 20, stats["seconds"], stats["pages"] / seconds, stats["bytes"] / 2 ** 20 / seconds))
+
+
+def _run(stage, jobs, pages, workers, progress):
+    # every job writes one file and returns its size, so nothing but the files in progress is held in memory
+    start = time.perf_counter()
+    written = 0
+    pool = ThreadPoolExecutor(max_workers=workers or os.cpu_count())
+    try:
+        futures = [pool.submit(job) for job in jobs]
+        for done, future in enumerate(as_completed(futures), 1):
+            written += future.result()
+            progress(stage, done, len(futures))
+    finally:
+        # a failed file stops the export instead of waiting for all others
+        pool.shutdown(cancel_futures=True)
+    count("bytes exported", written)
+    return {"files": len(jobs), "pages": pages, "bytes": written, "seconds": time.perf_counter() - start}
+
+
+def export_images(pages, sources, folder, stem, dpi=DEFAULT_DPI, image_format="png", workers=None, progress=None):
+    # sources are the (file, page index, digest) origins of unedited pages, which poppler rasterizes straight from
+    # their file, and None for edited pages. Each page is written as soon as it is rendered.
+    progress = progress or no_progress
+    digits = len(str(len(pages)))
+
+    def job(i):
+        source = sources[i]
+        with span("export image", page=i):
+            if source is not None:
+                image = render_range(source[0], source[1], source[1], dpi)[0]
+            else:
+                image = page_to_img(pages[i].flatten(), dpi)
+            path = os.path.join(folder, "%s-%0*d.%s" % (stem, digits, i + 1, image_format))
+            image.save(path)
+        return os.path.getsize(path)
+
+    return _run("Exporting images", [lambda i=i: job(i) for i in range(len(pages))], len(pages), workers, progress)
+
+
+def export_ranges(pages, ranges, folder, stem, optimize=True, workers=None, progress=None):
+    # one pdf per range of rows. pdfrw serializes its part of each write, the flattening, compressing and syncing of
+    # the files overlaps.
+    progress = progress or no_progress
+    digits = len(str(len(pages)))
+
+    def job(rows):
+        if len(rows) == 1:
+            name = "%s-%0*d.pdf" % (stem, digits, rows[0] + 1)
+        else:
+            name = "%s-%0*d-%0*d.pdf" % (stem, digits, rows[0] + 1, digits, rows[-1] + 1)
+        path = os.path.join(folder, name)
+        with span("export pdf", pages=len(rows)):
+            write_pdf([pages[row] for row in rows], path, optimize)
+        return os.path.getsize(path)
+
+    return _run("Splitting", [lambda rows=rows: job(rows) for rows in ranges], sum(map(len, ranges)), workers,
+                progress)
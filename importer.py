@@ -0,0 +1,68 @@
+import multiprocessing
+import os
+from concurrent.futures import ProcessPoolExecutor, as_completed
+
+from cache import ThumbnailDiskCache, file_digest, file_stat
+from document import read_pdf
+from instrument import no_progress, span
+from render import render_range, THUMBNAIL_DPI
+
+# thumbnails of this many leading pages of every file are rendered while it is imported, later ones on demand
+PRERENDER_PAGES = 32
+
+_disk_cache = None
+
+
+def _worker_disk_cache():
+    # one per worker process, the first write of a cache walks its whole folder to learn its size
+    global _disk_cache
+    if _disk_cache is None:
+        _disk_cache = ThumbnailDiskCache()
+    return _disk_cache
+
+
+def prepare_file(path, dpi=THUMBNAIL_DPI, pages=PRERENDER_PAGES):
+    # runs in a worker process: hashes the file and puts the thumbnails of its first pages into the disk cache, where
+    # the editor finds them once the rows become visible
+    stat = file_stat(path)
+    digest = file_digest(path)
+    disk_cache = _worker_disk_cache()
+    if disk_cache.get(digest, 0, dpi) is None:
+        try:
+            # poppler stops at the last page of shorter files
+            for i, image in enumerate(render_range(path, 0, pages - 1, dpi)):
+                disk_cache.put(digest, i, dpi, image)
+        except Exception:
+            # a file poppler cannot read gets its error from the parser, or is rendered page by page later
+            pass
+    # a file that was saved over in the meantime has no valid hash
+    return digest if file_stat(path) == stat else None
+
+
+def read_files(paths, workers=None, progress=None):
+    # pdfrw objects cannot be handed between processes, so the files are parsed here, in order, while worker processes
+    # hash and pre-render them. Returns (path, reader, digest, error) per file in the order of paths.
+    progress = progress or no_progress
+    readers = dict()
+    errors = dict()
+    digests = dict()
+    # spawned, as forking the editor would copy its threads' locks in whatever state they are
+    context = multiprocessing.get_context("spawn")
+    with ProcessPoolExecutor(max_workers=min(workers or os.cpu_count(), len(paths)) or 1, mp_context=context) as pool:
+        futures = {pool.submit(prepare_file, path): i for i, path in enumerate(paths)}
+        for i, path in enumerate(paths):
+            try:
+                with span("parse", path=path):
+                    readers[i] = read_pdf(path)
+            except Exception as error:
+                errors[i] = error
+
+        for done, future in enumerate(as_completed(futures), 1):
+            i = futures[future]
+            try:
+                digests[i] = future.result()
+            except Exception:
+                digests[i] = None
+            progress(os.path.basename(paths[i]), done, len(paths))
+
+    return [(path, readers.get(i), digests[i], errors.get(i)) for i, path in enumerate(paths)]
@@ -0,0 +1,105 @@
+import json
+import os
+import threading
+import time
+from contextlib import nullcontext
+
+# set to a file name to record where the time goes and write it there as a Chrome trace (chrome://tracing, Perfetto)
+TRACE_PATH = os.environ.get("PYEDITPDF_TRACE")
+MAX_EVENTS = 1_000_000
+
+_NOTHING = nullcontext()
+
+
+class _Span:
+
+    __slots__ = ("recorder", "name", "args", "start")
+
+    def __init__(self, recorder, name, args):
+        self.recorder = recorder
+        self.name = name
+        self.args = args
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+
+    def __exit__(self, *exc):
+        self.recorder.add_span(self.name, self.start, time.perf_counter(), self.args)
+
+
+# Spans (named, timed stretches of work on some thread) and counters, recorded only while enabled. Disabled, a span
+# costs one attribute lookup and a shared no-op context manager.
+class Recorder:
+
+    def __init__(self, enabled=False):
+        self.enabled = enabled
+        self.events = list()
+        self.dropped = 0
+        self.totals = dict()
+        self.counters = dict()
+        self._origin = time.perf_counter()
+        self._threads = dict()
+        self._lock = threading.Lock()
+
+    def span(self, name, **args):
+        if not self.enabled:
+            return _NOTHING
+        return _Span(self, name, args)
+
+    def count(self, name, amount=1):
+        if not self.enabled:
+            return
+        with self._lock:
+            value = self.counters[name] = self.counters.get(name, 0) + amount
+            self._add({"name": name, "ph": "C", "ts": self._us(time.perf_counter()), "args": {name: value}})
+
+    def add_span(self, name, start, end, args):
+        with self._lock:
+            count, seconds = self.totals.get(name, (0, 0.0))
+            self.totals[name] = count + 1, seconds + end - start
+            event = {"name": name, "ph": "X", "ts": self._us(start), "dur": (end - start) * 1e6}
+            if args:
+                event["args"] = args
+            self._add(event)
+
+    def _add(self, event):
+        if len(self.events) >= MAX_EVENTS:
+            self.dropped += 1
+            return
+        thread = threading.current_thread()
+        self._threads[thread.ident] = thread.name
+        event["pid"] = os.getpid()
+        event["tid"] = thread.ident
+        self.events.append(event)
+
+    def _us(self, seconds):
+        return (seconds - self._origin) * 1e6
+
+    def summary(self, spans=4):
+        # the stages that took the most time so far and all counters, short enough for a status bar
+        with self._lock:
+            slowest = sorted(self.totals.items(), key=lambda item: item[1][1], reverse=True)[:spans]
+            counters = sorted(self.counters.items())
+        parts = ["%s %.2f s (%d)" % (name, seconds, count) for name, (count, seconds) in slowest]
+        parts += ["%s %d" % (name, value) for name, value in counters]
+        return " | ".join(parts)
+
+    def export(self, path, **other):
+        # other is added to the trace's otherData, e.g. statistics of caches
+        with self._lock:
+            metadata = [{"name": "thread_name", "ph": "M", "pid": os.getpid(), "tid": ident, "args": {"name": name}}
+                        for ident, name in self._threads.items()]
+            trace = {"traceEvents": metadata + self.events, "displayTimeUnit": "ms",
+                     "otherData": dict(other, dropped_events=self.dropped)}
+        with open(path, "w") as f:
+            json.dump(trace, f)
+
+
+recorder = Recorder(enabled=TRACE_PATH is not None)
+span = recorder.span
+count = recorder.count
+
+
+def no_progress(stage, done, total):
+    # what long running functions report their progress to unless they are given a callback
+    pass
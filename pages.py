@@ -0,0 +1,108 @@
+import hashlib
+
+from pdfrw import PageMerge
+
+from instrument import span
+from render import page_fingerprint, page_size, pdfrw_lock
+
+
+def _unrotate(x, y, rotate):
+    # maps a point given in fractions of the rotated view back to fractions of the unrotated view (clockwise rotation)
+    if rotate == 90:
+        return y, 1 - x
+    elif rotate == 180:
+        return 1 - x, 1 - y
+    elif rotate == 270:
+        return 1 - y, x
+    return x, y
+
+
+# A page as the original source page plus all edits applied to it so far. Edits return a new EditPage with the
+# composed transform instead of wrapping the previous result, so the page is only merged once when it is flattened.
+#
+# viewrect is (x, y, w, h) in points from the top left of the source page as shown with its own /Rotate, the same
+# convention pdfrw uses. rotate is the clockwise rotation applied on top of that and scale the final scaling.
+class EditPage:
+
+    def __init__(self, source, origin=None, viewrect=None, rotate=0, scale=1):
+        self.source = source
+        self.origin = origin
+        self.viewrect = viewrect
+        self.rotate = rotate % 360
+        self.scale = scale
+        self._flat = None
+        self._fingerprint = None
+        self._view = viewrect
+
+    def _replace(self, **changes):
+        attributes = dict(viewrect=self.viewrect, rotate=self.rotate, scale=self.scale)
+        attributes.update(changes)
+        page = EditPage(self.source, self.origin, **attributes)
+        if "viewrect" not in changes:
+            # the view of the source page is the same whatever the rotation and scale, and takes the pdfrw_lock
+            page._view = self._view
+        return page
+
+    @property
+    def unedited(self):
+        return self.viewrect is None and self.rotate == 0 and self.scale == 1
+
+    @property
+    def view(self):
+        if self._view is None:
+            with pdfrw_lock:
+                width, height = page_size(self.source)
+            self._view = 0, 0, width, height
+        return self._view
+
+    @property
+    def size(self):
+        _, _, width, height = self.view
+        if self.rotate in (90, 270):
+            width, height = height, width
+        return width * self.scale, height * self.scale
+
+    def rotated(self, angle=90):
+        return self._replace(rotate=self.rotate + angle)
+
+    def cropped(self, selection):
+        # selection is (x1, y1, x2, y2) in fractions of the page as it is displayed, from the top left
+        x1, y1 = _unrotate(selection[0], selection[1], self.rotate)
+        x2, y2 = _unrotate(selection[2], selection[3], self.rotate)
+        x1, x2 = min(x1, x2), max(x1, x2)
+        y1, y2 = min(y1, y2), max(y1, y2)
+
+        x, y, w, h = self.view
+        return self._replace(viewrect=(x + x1 * w, y + y1 * h, (x2 - x1) * w, (y2 - y1) * h))
+
+    def adjusted(self, margin=0, scale=1):
+        # margin is cut from every side, or is (left, top, right, bottom) of the source page, in points
+        left, top, right, bottom = margin if isinstance(margin, tuple) else (margin,) * 4
+        x, y, w, h = self.view
+        return self._replace(viewrect=(x + left, y + top, w - left - right, h - top - bottom),
+                             scale=self.scale * scale)
+
+    def flatten(self):
+        flat = self._flat
+        if flat is None:
+            with pdfrw_lock, span("flatten"):
+                merge = PageMerge().add(self.source, viewrect=self.viewrect, rotate=self.rotate)
+                if self.scale != 1:
+                    merge[0].scale(self.scale)
+                flat = self._flat = merge.render()
+        return flat
+
+    def release(self):
+        # the flattened page is about as large as its source, flatten builds it again when it is needed
+        self._flat = None
+
+    @property
+    def fingerprint(self):
+        if self._fingerprint is None:
+            source = vars(self.source).get("_page_fingerprint")
+            if source is None:
+                source = page_fingerprint(self.source)
+                self.source.private._page_fingerprint = source
+            transform = repr((self.viewrect, self.rotate, self.scale)).encode()
+            self._fingerprint = hashlib.sha1(source.encode() + transform).hexdigest()
+        return self._fingerprint
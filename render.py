@@ -0,0 +1,143 @@
+import hashlib
+import threading
+
+from pdfrw import PdfArray, PdfDict
+from pdfrw.buildxobj import pagexobj, get_rotation, rotate_rect
+
+# reportlab and pdf2image are imported where they are first used, they take longer to load than the whole window
+from instrument import count, span
+
+DEFAULT_DPI = 200
+PREVIEW_DPI = DEFAULT_DPI
+# keeps large-format pages (A0 drawings and the like) from producing huge preview bitmaps, zooming in fills in tiles
+PREVIEW_MAX_PIXELS = 16_000_000
+THUMBNAIL_DPI = 20
+THUMBNAIL_SIZE = (200, 200)
+
+# pdfrw caches form xobjects on the page objects and resolves indirect objects through a shared tokenizer, so every
+# walk over a document's objects is serialized between threads
+pdfrw_lock = threading.Lock()
+
+# back references that would otherwise pull the whole document into a page's fingerprint
+_FINGERPRINT_SKIP = {"/Parent", "/P"}
+_INHERITABLE = ("/Resources", "/MediaBox", "/CropBox", "/Rotate")
+
+
+def page_to_pdf(page):
+    from reportlab.pdfgen.canvas import Canvas
+    from pdfrw.toreportlab import makerl
+    with pdfrw_lock, span("reportlab"):
+        canvas = Canvas("temp.pdf")
+        xobj = pagexobj(page)
+        canvas.setPageSize((xobj.BBox[2], xobj.BBox[3]))
+        canvas.saveState()
+        canvas.doForm(makerl(canvas, xobj))
+        canvas.restoreState()
+        canvas.showPage()
+        return canvas.getpdfdata()
+
+
+def page_to_img(page, dpi=DEFAULT_DPI):
+    from pdf2image import convert_from_bytes
+    data = page_to_pdf(page)
+    with span("poppler", dpi=dpi):
+        image = convert_from_bytes(data, dpi=dpi)[0]
+    count("pages rendered")
+    return image
+
+
+def page_size(page):
+    # size in points as displayed, i.e. of the crop box after applying the page rotation
+    inheritable = page.inheritable
+    box = [float(x) for x in (inheritable.CropBox or inheritable.MediaBox)]
+    x1, y1, x2, y2 = rotate_rect(box, get_rotation(inheritable.Rotate))
+    return x2 - x1, y2 - y1
+
+
+def preview_dpi(size):
+    width, height = size
+    max_dpi = (PREVIEW_MAX_PIXELS / max(width * height / 72 ** 2, 1)) ** 0.5
+    return min(PREVIEW_DPI, int(max_dpi))
+
+
+
+def render_range(path, first_page, last_page, dpi=DEFAULT_DPI, thread_count=1):
+    # first_page and last_page are 0-based and inclusive; poppler rasterizes the whole range in one go
+    from pdf2image import convert_from_path
+    with span("poppler", dpi=dpi, pages=last_page - first_page + 1):
+        images = convert_from_path(path, dpi=dpi, first_page=first_page + 1, last_page=last_page + 1,
+                                   thread_count=thread_count, use_cropbox=True)
+    count("pages rendered", len(images))
+    return images
+
+
+def stream_digest(obj):
+    # streams (images, fonts, content) are by far the most expensive part to hash and are shared between pages
+    cached = vars(obj).get("_fingerprint")
+    if cached is not None and cached[0] is obj.stream:
+        return cached[1]
+    digest = hashlib.sha1(obj.stream.encode("latin-1")).digest()
+    obj.private._fingerprint = (obj.stream, digest)
+    return digest
+
+
+def page_fingerprint(page):
+    # content hash of everything reachable from the page, identical for equal pages even if they are distinct objects
+    digest = hashlib.sha1()
+    seen = dict()
+
+    def visit(obj):
+        if isinstance(obj, (PdfDict, PdfArray)):
+            if id(obj) in seen:
+                digest.update(b"@%d" % seen[id(obj)])
+                return
+            seen[id(obj)] = len(seen)
+
+        if isinstance(obj, PdfDict):
+            digest.update(b"<<")
+            for key, value in sorted(obj.iteritems()):
+                if key not in _FINGERPRINT_SKIP:
+                    digest.update(key.encode("latin-1"))
+                    visit(value)
+            if obj.stream is not None:
+                digest.update(b"stream")
+                digest.update(stream_digest(obj))
+            digest.update(b">>")
+        elif isinstance(obj, PdfArray):
+            digest.update(b"[")
+            for value in obj:
+                visit(value)
+            digest.update(b"]")
+        else:
+            digest.update(str(obj).encode("latin-1", "replace"))
+            digest.update(b" ")
+
+    with pdfrw_lock, span("fingerprint"):
+        visit(page)
+        # attributes a page inherits from its page tree are part of how it looks
+        for key in _INHERITABLE:
+            if key not in page:
+                digest.update(key.encode("latin-1"))
+                visit(page.inheritable[key])
+    return digest.hexdigest()
+
+
+def thumbnail_from(image):
+    thumbnail = image.copy()
+    thumbnail.thumbnail(THUMBNAIL_SIZE)
+    return thumbnail
+
+
+def contiguous_runs(rows, sources, max_length):
+    # groups rows whose (file, page index) sources follow each other, so each group is one render_range call
+    runs = []
+    for row in sorted(rows):
+        source = sources[row]
+        if runs:
+            last_row, last_source = runs[-1][-1], sources[runs[-1][-1]]
+            if (row == last_row + 1 and source[0] == last_source[0] and source[1] == last_source[1] + 1
+                    and len(runs[-1]) < max_length):
+                runs[-1].append(row)
+                continue
+        runs.append([row])
+    return runs
@@ -0,0 +1,121 @@
+import heapq
+import itertools
+import os
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+from PyQt5 import QtCore
+from PyQt5.QtCore import Qt, pyqtSignal
+
+PRIORITY_CURRENT = 0
+PRIORITY_VISIBLE = 1
+PRIORITY_BACKGROUND = 2
+
+
+# Runs render jobs on a thread pool and hands the results back to the GUI thread. Submitting a key again replaces the
+# older job and results of replaced or cancelled jobs are dropped, so an edited page never shows a stale image.
+class RenderScheduler(QtCore.QObject):
+
+    finished = pyqtSignal(object, object)
+    failed = pyqtSignal(object, object)
+
+    _done = pyqtSignal(object, int, object, object)
+
+    def __init__(self, max_workers=None, parent=None):
+        super().__init__(parent=parent)
+        self.max_workers = max_workers or os.cpu_count() or 1
+        self._executor = ThreadPoolExecutor(max_workers=self.max_workers, thread_name_prefix="render")
+        self._counter = itertools.count()
+        self._queue = []
+        self._pending = {}
+        self._current = {}
+        self._in_flight = 0
+        self._done.connect(self._on_done, Qt.QueuedConnection)
+
+    def submit(self, key, func, *args, priority=PRIORITY_BACKGROUND):
+        token = next(self._counter)
+        self._current[key] = token
+        self._pending[key] = (token, priority, func, args)
+        heapq.heappush(self._queue, (priority, token, key))
+        self._dispatch()
+
+    def promote(self, key, priority):
+        job = self._pending.get(key)
+        if job is not None and priority < job[1]:
+            token, _, func, args = job
+            self._pending[key] = (token, priority, func, args)
+            heapq.heappush(self._queue, (priority, next(self._counter), key))
+            self._dispatch()
+
+    def is_scheduled(self, key):
+        return key in self._current
+
+    def cancel(self, key):
+        self._current.pop(key, None)
+        self._pending.pop(key, None)
+
+    def cancel_all(self):
+        self._current.clear()
+        self._pending.clear()
+        self._queue.clear()
+
+    def shutdown(self):
+        self.cancel_all()
+        self._executor.shutdown(wait=False)
+
+    def _dispatch(self):
+        while self._in_flight < self.max_workers and self._queue:
+            priority, _, key = heapq.heappop(self._queue)
+            job = self._pending.get(key)
+            if job is None or job[1] != priority:
+                continue  # cancelled, replaced or promoted in the meantime
+            del self._pending[key]
+            token, _, func, args = job
+            self._in_flight += 1
+            self._executor.submit(self._run, key, token, func, args)
+
+    def _run(self, key, token, func, args):
+        try:
+            self._done.emit(key, token, func(*args), None)
+        except Exception as e:
+            self._done.emit(key, token, None, e)
+
+    def _on_done(self, key, token, result, error):
+        self._in_flight -= 1
+        if self._current.get(key) == token:
+            del self._current[key]
+            if error is None:
+                self.finished.emit(key, result)
+            else:
+                self.failed.emit(key, error)
+        self._dispatch()
+
+
+# Runs a single long task, such as saving, on its own thread. The task gets a progress callback as keyword argument
+# and all three signals are delivered on the GUI thread.
+class BackgroundTask(QtCore.QObject):
+
+    progress = pyqtSignal(str, int, int)
+    finished = pyqtSignal(object)
+    failed = pyqtSignal(object)
+
+    def __init__(self, func, *args, parent=None):
+        super().__init__(parent=parent)
+        self.func = func
+        self.args = args
+        self._thread = None
+
+    def start(self):
+        self._thread = threading.Thread(target=self._run, name="task")
+        self._thread.start()
+
+    def is_running(self):
+        return self._thread is not None and self._thread.is_alive()
+
+    def _run(self):
+        try:
+            result = self.func(*self.args, progress=self.progress.emit)
+        except Exception as e:
+            self.failed.emit(e)
+        else:
+            self.finished.emit(result)
@@ -0,0 +1,60 @@
+import os
+
+import pytest
+from pdfrw import PdfReader
+
+import cli
+
+
+def test_edits_files_into_output_folder(make_pdf, tmp_path):
+    path = make_pdf(4)
+    output = tmp_path / "out"
+    assert cli.main([path, "-o", str(output), "--delete", "2-3", "--rotate", "90", "--pages", "1", "-j", "1"]) == 0
+    pages = PdfReader(str(output / os.path.basename(path))).pages
+    assert [float(x) for x in pages[0].MediaBox] == [0, 0, 200, 100]
+    assert len(pages) == 2
+
+
+def test_merge(make_pdf, tmp_path):
+    merged = str(tmp_path / "merged.pdf")
+    assert cli.main([make_pdf(4, "a.pdf"), make_pdf(2, "b.pdf"), "--merge", merged]) == 0
+    assert len(PdfReader(merged).pages) == 6
+
+
+def test_in_place(make_pdf):
+    path = make_pdf(4)
+    assert cli.main([path, "--in-place", "--delete", "1", "-j", "1"]) == 0
+    assert len(PdfReader(path).pages) == 3
+
+
+def test_failed_file_fails_the_run(make_pdf, tmp_path):
+    missing = str(tmp_path / "missing.pdf")
+    assert cli.main([make_pdf(2), missing, "-o", str(tmp_path / "out"), "-j", "1"]) == 1
+    assert os.path.exists(tmp_path / "out" / "pages.pdf")
+
+
+def test_range_outside_the_document_fails(make_pdf, tmp_path):
+    assert cli.main([make_pdf(2), "-o", str(tmp_path / "out"), "--delete", "5", "-j", "1"]) == 1
+    assert cli.main([make_pdf(2), "--merge", str(tmp_path / "merged.pdf"), "--pages", "0-1"]) == 1
+
+
+def test_same_file_names_are_refused(make_pdf, tmp_path):
+    os.makedirs(tmp_path / "other")
+    first = make_pdf(2)
+    second = make_pdf(2, os.path.join("other", "pages.pdf"))
+    assert cli.main([first, second, "-o", str(tmp_path / "out")]) == 2
+
+
+def test_usage_errors(make_pdf):
+    with pytest.raises(SystemExit) as error:
+        cli.main([make_pdf(2)])
+    assert error.value.code == 2
+    with pytest.raises(SystemExit) as error:
+        cli.main([make_pdf(2), "--in-place", "--rotate", "45"])
+    assert error.value.code == 2
+
+
+def test_parse_ranges():
+    assert cli.parse_ranges("1-3,7", 7) == [0, 1, 2, 6]
+    with pytest.raises(ValueError):
+        cli.parse_ranges("3-1", 7)
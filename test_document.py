@@ -0,0 +1,130 @@
+from pdfrw import PdfReader
+
+from document import Document
+
+
+def widths(document):
+    return [float(page.source.MediaBox[2]) - 100 for page in document.pages]
+
+
+def test_undo_after_save_does_not_trust_moved_pages(make_pdf):
+    path = make_pdf(4)
+    document = Document(path)
+    document.rotate([1])
+    document.delete([0])
+    document.save()
+    document.undo()
+    document.undo()
+
+    assert widths(document) == [0, 1, 2, 3]
+    saved = PdfReader(path).pages
+    for row in range(len(document)):
+        source = document.source(row)
+        if source is not None:
+            assert saved[source[1]].MediaBox == document.pages[row].source.MediaBox
+            assert saved[source[1]].Rotate in (None, "0", 0)
+    assert document.source(0) is None
+    assert document.source(1) is None
+    assert document.source(2)[1] == 1
+
+
+def test_rotate_undo_redo(make_pdf):
+    document = Document(make_pdf(4))
+    original = list(document.pages)
+
+    document.rotate([0, 2])
+    assert [page.rotate for page in document.pages] == [90, 0, 90, 0]
+    assert document.pages[0].size == (200, 100)
+    rotated = list(document.pages)
+
+    assert document.undo()[0] == "rotate"
+    assert all(a is b for a, b in zip(document.pages, original))
+    document.redo()
+    assert all(a is b for a, b in zip(document.pages, rotated))
+
+
+def test_crop_in_fractions_of_the_page_as_displayed(make_pdf):
+    document = Document(make_pdf(2))
+    document.crop([1], (0, 0, 0.5, 0.25))
+    assert document.pages[1].viewrect == (0, 0, 50.5, 50)
+    assert document.pages[1].size == (50.5, 50)
+
+    # the left half of a page rotated clockwise is the bottom half of the unrotated page
+    document.rotate([0])
+    document.crop([0], (0, 0, 0.5, 1))
+    assert document.pages[0].viewrect == (0, 100, 100, 100)
+    assert document.pages[0].size == (100, 100)
+
+
+
+def test_adjust_margins_per_side(make_pdf):
+    document = Document(make_pdf(2))
+    document.adjust([0], 10)
+    assert document.pages[0].viewrect == (10, 10, 80, 180)
+    document.adjust([1], (1, 2, 3, 4), scale=2)
+    assert document.pages[1].viewrect == (1, 2, 97, 194)
+    assert document.pages[1].size == (194, 388)
+
+def test_delete_undo_redo(make_pdf):
+    document = Document(make_pdf(4))
+    document.delete([3, 1])
+    assert widths(document) == [0, 2]
+    document.undo()
+    assert widths(document) == [0, 1, 2, 3]
+    document.redo()
+    assert widths(document) == [0, 2]
+
+
+def test_new_edit_clears_redo(make_pdf):
+    document = Document(make_pdf(2))
+    document.rotate([0])
+    document.undo()
+    assert document.history.can_redo()
+    document.delete([1])
+    assert not document.history.can_redo()
+
+
+def test_adding_pages_is_undoable_opening_is_not(make_pdf):
+    document = Document(make_pdf(4))
+    assert not document.history.can_undo()
+    document.add(make_pdf(2, "more.pdf"))
+    assert widths(document) == [0, 1, 2, 3, 0, 1]
+    document.undo()
+    assert len(document) == 4
+    document.redo()
+    assert len(document) == 6
+
+
+def test_files_opened_together_are_not_undoable(make_pdf):
+    document = Document()
+    document.add(make_pdf(2))
+    document.add(make_pdf(3, "more.pdf"), record=False)
+    assert len(document) == 5
+    assert not document.history.can_undo()
+
+
+def test_history_drops_oldest_edits_over_budget(make_pdf):
+    document = Document(make_pdf(4))
+    document.history.budget = 1
+    document.rotate([0])
+    document.rotate([1])
+    assert document.history.can_undo()
+    document.undo()
+    assert not document.history.can_undo()
+    assert [page.rotate for page in document.pages] == [90, 0, 0, 0]
+
+
+def test_pages_only_the_history_keeps_release_their_flattened_copy(make_pdf):
+    document = Document(make_pdf(2))
+    for page in document.pages:
+        page.flatten()
+    original = document.pages[0]
+    document.rotate([0])
+    assert original._flat is None
+    rotated = document.pages[0]
+    rotated.flatten()
+    document.undo()
+    assert rotated._flat is None and original.flatten() is not None
+    kept = document.pages[1]
+    document.delete([1])
+    assert kept._flat is None
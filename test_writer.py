@@ -0,0 +1,171 @@
+import os
+
+from pdfrw import IndirectPdfDict, PdfArray, PdfDict, PdfName, PdfReader, PdfWriter
+
+from document import Document, write_document
+from export import export_ranges
+
+
+def test_optimized_write_leaves_source_objects_alone(make_pdf, tmp_path):
+    path = make_pdf(4)
+    document = Document(path)
+    contents = document.pages[0].source.Contents
+    stream, indirect = contents.stream, contents.indirect
+
+    export_ranges(document.pages, [range(0, 2), range(2, 4)], str(tmp_path), "split")
+    document.save(str(tmp_path / "copy.pdf"))
+
+    assert (contents.stream, contents.indirect) == (stream, indirect)
+    document.path = path
+    document.rotate([0])
+    incremental, _ = write_document(list(document.pages), path, document.base)
+    assert incremental
+    assert PdfReader(path).pages[0].Rotate == "90"
+
+
+def saved_widths(path):
+    return [float(page.MediaBox[2]) - 100 for page in PdfReader(path).pages]
+
+
+def read_bytes(path):
+    with open(path, "rb") as f:
+        return f.read()
+
+
+def save(document, path=None):
+    # returns whether the save appended to the file
+    snapshot = list(document.pages)
+    incremental, digest = write_document(snapshot, path or document.path, document.base)
+    document.saved(snapshot, digest)
+    return incremental
+
+
+def test_incremental_save_appends_rotate_and_crop(make_pdf):
+    path = make_pdf(4)
+    before = read_bytes(path)
+    document = Document(path)
+    document.rotate([1])
+    document.crop([2], (0, 0, 0.5, 0.5))
+
+    assert save(document)
+    assert read_bytes(path).startswith(before)
+    pages = PdfReader(path).pages
+    assert pages[1].Rotate == "90"
+    assert [float(x) for x in pages[2].CropBox] == [0, 100, 51, 200]
+    assert pages[0].Rotate is None and pages[0].CropBox is None
+
+
+def test_incremental_save_rewrites_kids(make_pdf):
+    path = make_pdf(4)
+    document = Document(path)
+    document.delete([0, 2])
+
+    assert save(document)
+    reader = PdfReader(path)
+    assert len(reader.Root.Pages.Kids) == 2
+    assert reader.Root.Pages.Count == "2"
+    assert saved_widths(path) == [1, 3]
+
+    # the next save appends to the update before it
+    document.undo()
+    assert save(document)
+    assert saved_widths(path) == [0, 1, 2, 3]
+
+
+def test_incremental_save_of_a_page_edited_back(make_pdf):
+    path = make_pdf(2)
+    document = Document(path)
+    document.rotate([0])
+    assert save(document)
+    document.undo()
+    assert save(document)
+    assert PdfReader(path).pages[0].Rotate == "0"
+
+
+def test_unchanged_document_leaves_file_alone(make_pdf):
+    path = make_pdf(2)
+    before = read_bytes(path)
+    document = Document(path)
+    assert save(document)
+    assert read_bytes(path) == before
+
+
+def test_scaled_pages_are_rewritten(make_pdf):
+    path = make_pdf(2)
+    document = Document(path)
+    document.adjust([0], scale=2)
+    assert not save(document)
+    assert float(PdfReader(path).pages[0].MediaBox[2]) == 200
+
+
+def test_other_path_is_rewritten(make_pdf, tmp_path):
+    path = make_pdf(2)
+    document = Document(path)
+    document.rotate([0])
+    assert not save(document, str(tmp_path / "other.pdf"))
+    assert [float(x) for x in PdfReader(str(tmp_path / "other.pdf")).pages[0].MediaBox] == [0, 0, 200, 100]
+
+
+def test_file_changed_since_opening_is_rewritten(make_pdf):
+    path = make_pdf(2)
+    document = Document(path)
+    document.rotate([0])
+    stat = os.stat(path)
+    os.utime(path, ns=(stat.st_atime_ns, stat.st_mtime_ns + 10 ** 9))
+    assert not save(document)
+    assert len(PdfReader(path).pages) == 2
+
+
+def test_pages_from_other_files_are_rewritten(make_pdf):
+    path = make_pdf(2)
+    document = Document(path)
+    document.add(make_pdf(1, "other.pdf"))
+    assert not save(document)
+    assert saved_widths(path) == [0, 1, 0]
+
+
+def test_duplicated_pages_are_rewritten(make_pdf):
+    path = make_pdf(2)
+    document = Document(path)
+    pages = [document.pages[0], document.pages[0], document.pages[1]]
+    incremental, _ = write_document(pages, path, document.base)
+    assert not incremental
+    assert saved_widths(path) == [0, 0, 1]
+
+
+def test_nested_page_tree_is_rewritten_when_pages_move(tmp_path):
+    leaves = [IndirectPdfDict(Type=PdfName.Page, MediaBox=[0, 0, 100 + i, 200], Contents=PdfDict(stream="0 0 m S"))
+              for i in range(4)]
+    nodes = [IndirectPdfDict(Type=PdfName.Pages, Kids=PdfArray(leaves[i:i + 2]), Count=2) for i in (0, 2)]
+    root = IndirectPdfDict(Type=PdfName.Pages, Kids=PdfArray(nodes), Count=4)
+    for node in nodes:
+        node.Parent = root
+        for leaf in node.Kids:
+            leaf.Parent = node
+    writer = PdfWriter()
+    writer.trailer = PdfDict(Root=IndirectPdfDict(Type=PdfName.Catalog, Pages=root))
+    path = str(tmp_path / "nested.pdf")
+    writer.write(path)
+
+    document = Document(path)
+    document.rotate([3])
+    assert save(document)
+    document.delete([0])
+    assert not save(document)
+    assert [float(page.MediaBox[2]) for page in PdfReader(path).pages] == [101, 102, 200]
+
+
+def test_direct_page_objects_are_rewritten(tmp_path):
+    # the pages are written inline into /Kids, without an object number to replace them by
+    writer = PdfWriter()
+    pages = PdfArray([PdfDict(Type=PdfName.Page, MediaBox=[0, 0, 100 + i, 200], Contents=PdfDict(stream="0 0 m S"))
+                      for i in range(2)])
+    writer.trailer = PdfDict(Root=IndirectPdfDict(Type=PdfName.Catalog,
+                                                  Pages=IndirectPdfDict(Type=PdfName.Pages, Kids=pages, Count=2)))
+    path = str(tmp_path / "direct.pdf")
+    writer.write(path)
+
+    document = Document(path)
+    document.rotate([1])
+    assert not save(document)
+    assert [float(page.MediaBox[2]) for page in PdfReader(path).pages] == [100, 200]
@@ -0,0 +1,69 @@
+from instrument import no_progress, span
+from render import contiguous_runs, page_to_img, render_range
+
+# low enough to rasterize hundreds of pages in seconds, a pixel is 2 points
+TRIM_DPI = 36
+# pixels darker than this count as content, which keeps the grain of scanned paper out
+THRESHOLD = 220
+# rows and columns need this share of content pixels, so that specks and dust do not stretch the box
+MIN_COVERAGE = 0.005
+PADDING = 0.01
+
+
+def render_pages(pages, sources, dpi=TRIM_DPI, progress=None):
+    # unedited pages are rasterized straight from their files in as few poppler runs as possible, edited ones one by one
+    progress = progress or no_progress
+    images = [None] * len(pages)
+    runs = contiguous_runs([i for i, source in enumerate(sources) if source is not None], sources, 64)
+    for run in runs:
+        first = sources[run[0]]
+        for i, image in zip(run, render_range(first[0], first[1], first[1] + len(run) - 1, dpi)):
+            images[i] = image
+        progress("Rendering", sum(image is not None for image in images), len(pages))
+    for i, page in enumerate(pages):
+        if images[i] is None:
+            images[i] = page_to_img(page.flatten(), dpi)
+            progress("Rendering", sum(image is not None for image in images), len(pages))
+    return images
+
+
+def _bounds(has_content):
+    # first and last True along the last axis of a (pages, length) array
+    found = has_content.any(axis=1)
+    first = has_content.argmax(axis=1)
+    last = has_content.shape[1] - 1 - has_content[:, ::-1].argmax(axis=1)
+    return found, first, last
+
+
+def content_boxes(images, threshold=THRESHOLD, min_coverage=MIN_COVERAGE, padding=PADDING):
+    # the box around the content of each image as (x1, y1, x2, y2) in fractions from the top left, the convention of
+    # EditPage.cropped, or None for blank pages and pages without margins. Images of the same size are stacked and
+    # measured together.
+    import numpy as np
+    boxes = [None] * len(images)
+    by_size = dict()
+    for i, image in enumerate(images):
+        by_size.setdefault(image.size, []).append(i)
+
+    for (width, height), indices in by_size.items():
+        stack = np.stack([np.asarray(images[i].convert("L")) for i in indices])
+        content = stack < threshold
+        rows_found, top, bottom = _bounds(content.mean(axis=2) >= min_coverage)
+        columns_found, left, right = _bounds(content.mean(axis=1) >= min_coverage)
+
+        x1 = np.clip(left / width - padding, 0, 1)
+        x2 = np.clip((right + 1) / width + padding, 0, 1)
+        y1 = np.clip(top / height - padding, 0, 1)
+        y2 = np.clip((bottom + 1) / height + padding, 0, 1)
+        trimmed = rows_found & columns_found & ((x1 > 0) | (y1 > 0) | (x2 < 1) | (y2 < 1))
+        for j, i in enumerate(indices):
+            if trimmed[j]:
+                boxes[i] = float(x1[j]), float(y1[j]), float(x2[j]), float(y2[j])
+    return boxes
+
+
+def trim_boxes(pages, sources, dpi=TRIM_DPI, progress=None):
+    # sources are the (file, page index, digest) origins of unedited pages and None for edited ones
+    images = render_pages(pages, sources, dpi, progress)
+    with span("trim", pages=len(pages)):
+        return content_boxes(images)
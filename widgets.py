@@ -1,59 +1,215 @@
 # partially from https://doc.qt.io/qtforpython/overviews/qtwidgets-widgets-imageviewer-example.html
 
-from PIL import Image
-from PyQt5 import QtGui, QtWidgets
+from collections import OrderedDict
+
+from PyQt5 import QtCore, QtGui, QtWidgets
 from PyQt5.QtCore import Qt, pyqtSignal
 from PyQt5.QtGui import QPainter, QPen
 from PyQt5.QtWidgets import QScrollArea, QSizePolicy, QHBoxLayout, QPushButton, QGridLayout
 from typing import Tuple
 
+from instrument import span
+
+
+_QT_FORMATS = {
+    "RGB": (QtGui.QImage.Format_RGB888, 3),
+    "RGBA": (QtGui.QImage.Format_RGBA8888, 4),
+    "L": (QtGui.QImage.Format_Grayscale8, 1),
+    "P": (QtGui.QImage.Format_Indexed8, 1),
+}
+
 
 def pil2pixmap(im):
-    if im.mode == "RGB":
-        r, g, b = im.split()
-        im = Image.merge("RGB", (b, g, r))
-    elif im.mode == "RGBA":
-        r, g, b, a = im.split()
-        im = Image.merge("RGBA", (b, g, r, a))
-    elif im.mode == "L":
-        im = im.convert("RGBA")
-    im2 = im.convert("RGBA")
-    data = im2.tobytes("raw", "RGBA")
-    qim = QtGui.QImage(data, im.size[0], im.size[1], QtGui.QImage.Format_ARGB32)
-    pixmap = QtGui.QPixmap.fromImage(qim)
-    return pixmap
-
-
-class PageLabel(QtWidgets.QLabel):
+    # wraps the raw pixel data in a QImage of the matching format, so the only copies are the one out of PIL and the
+    # upload into the pixmap instead of splitting, merging and converting every channel first
+    with span("pil2pixmap"):
+        if im.mode == "1":
+            im = im.convert("L")
+        elif im.mode == "P" and "transparency" in im.info or im.mode not in _QT_FORMATS:
+            im = im.convert("RGBA")
+        qt_format, channels = _QT_FORMATS[im.mode]
+        data = im.tobytes()
+        # rows of the raw data are not padded to 32 bits as QImage assumes by default
+        qim = QtGui.QImage(data, im.width, im.height, im.width * channels, qt_format)
+        if im.mode == "P":
+            palette = im.getpalette()
+            qim.setColorTable([QtGui.qRgb(*palette[i:i + 3]) for i in range(0, len(palette), 3)])
+        # fromImage copies the pixels, data only has to outlive qim until then
+        return QtGui.QPixmap.fromImage(qim)
+
+
+class PageListModel(QtCore.QAbstractListModel):
+
+    thumbnailRequested = pyqtSignal(int)
+    # pixmaps are kept for this many rows, the least recently painted ones are dropped and requested again from the
+    # render cache once they scroll back into view
+    MAX_PIXMAPS = 256
+
+    def __init__(self, parent=None):
+        super().__init__(parent=parent)
+        self._thumbnails = []
+        self._requested = []
+        # id of every pixmap in _thumbnails to the pixmap, least recently painted first
+        self._painted = OrderedDict()
+
+    def rowCount(self, parent=QtCore.QModelIndex()):
+        if parent.isValid():
+            return 0
+        return len(self._thumbnails)
+
+    def data(self, index, role=Qt.DisplayRole):
+        if not index.isValid():
+            return None
+        row = index.row()
+        if role == Qt.DecorationRole:
+            # the view only asks for rows it is about to paint, so this is where rendering is triggered
+            if self._thumbnails[row] is None and not self._requested[row]:
+                self._requested[row] = True
+                self.thumbnailRequested.emit(row)
+            pix_map = self._thumbnails[row]
+            if pix_map is not None:
+                self._painted.move_to_end(id(pix_map))
+            return pix_map
+        elif role == Qt.ToolTipRole:
+            return "Page " + str(row + 1)
+        return None
+
+    def clear(self):
+        self.beginResetModel()
+        self._thumbnails = []
+        self._requested = []
+        self._painted.clear()
+        self.endResetModel()
+
+    def reset_pages(self, count):
+        self.beginResetModel()
+        self._thumbnails = [None] * count
+        self._requested = [False] * count
+        self._painted.clear()
+        self.endResetModel()
+
+    def append_pages(self, count):
+        if count <= 0:
+            return
+        first = len(self._thumbnails)
+        self.beginInsertRows(QtCore.QModelIndex(), first, first + count - 1)
+        self._thumbnails.extend([None] * count)
+        self._requested.extend([False] * count)
+        self.endInsertRows()
+
+    def remove_pages(self, rows):
+        rows = set(rows)
+        if not rows:
+            return
+        for row in rows:
+            self._forget(row)
+        first, last = min(rows), max(rows)
+        if last - first + 1 == len(rows):
+            self.beginRemoveRows(QtCore.QModelIndex(), first, last)
+            del self._thumbnails[first:last + 1]
+            del self._requested[first:last + 1]
+            self.endRemoveRows()
+        else:
+            # one reset instead of a signal per row keeps deleting large scattered selections linear
+            self.beginResetModel()
+            self._thumbnails = [pix_map for row, pix_map in enumerate(self._thumbnails) if row not in rows]
+            self._requested = [requested for row, requested in enumerate(self._requested) if row not in rows]
+            self.endResetModel()
+
+    def set_thumbnail(self, row, pil_img):
+        self._forget(row)
+        pix_map = self._thumbnails[row] = pil2pixmap(pil_img)
+        self._painted[id(pix_map)] = pix_map
+        self._requested[row] = True
+        index = self.index(row)
+        self.dataChanged.emit(index, index, [Qt.DecorationRole])
+        if len(self._painted) > self.MAX_PIXMAPS:
+            self._drop_pixmaps()
+
+    def _forget(self, row):
+        pix_map = self._thumbnails[row]
+        if pix_map is not None:
+            del self._painted[id(pix_map)]
+
+    def _drop_pixmaps(self):
+        # a quarter at a time, so the rows are only scanned once in a while
+        dropped = set()
+        while len(self._painted) > self.MAX_PIXMAPS * 3 // 4:
+            dropped.add(self._painted.popitem(last=False)[0])
+        for row, pix_map in enumerate(self._thumbnails):
+            if pix_map is not None and id(pix_map) in dropped:
+                self._thumbnails[row] = None
+                self._requested[row] = False
+
+    def reset_requests(self):
+        for row, pix_map in enumerate(self._thumbnails):
+            if pix_map is None:
+                self._requested[row] = False
+        if self._thumbnails:
+            self.dataChanged.emit(self.index(0), self.index(len(self._thumbnails) - 1), [Qt.DecorationRole])
+
+    def invalidate(self, rows):
+        if not rows:
+            return
+        for row in rows:
+            self._forget(row)
+            self._thumbnails[row] = None
+            self._requested[row] = False
+        self.dataChanged.emit(self.index(min(rows)), self.index(max(rows)), [Qt.DecorationRole])
+
+
+class PageDelegate(QtWidgets.QStyledItemDelegate):
+
+    def __init__(self, item_height=100, margin=5, parent=None):
+        super().__init__(parent=parent)
+        self.item_height = item_height
+        self.margin = margin
+
+    def sizeHint(self, option, index):
+        return QtCore.QSize(option.rect.width(), self.item_height)
+
+    def paint(self, painter, option, index):
+        style = option.widget.style() if option.widget is not None else QtWidgets.QApplication.style()
+        style.drawPrimitive(QtWidgets.QStyle.PE_PanelItemViewItem, option, painter, option.widget)
+
+        pix_map = index.data(Qt.DecorationRole)
+        if pix_map is None:
+            return
+
+        target = option.rect.adjusted(self.margin, self.margin, -self.margin, -self.margin)
+        size = pix_map.size().scaled(target.size(), Qt.KeepAspectRatio)
+        x = target.x() + (target.width() - size.width()) // 2
+        y = target.y() + (target.height() - size.height()) // 2
+        painter.drawPixmap(QtCore.QRect(x, y, size.width(), size.height()), pix_map)
+
+
+class PageListView(QtWidgets.QListView):
 
     actionEvent = pyqtSignal(str)
 
-    def __init__(self, pil_img, parent=None):
+    def __init__(self, parent=None):
         super().__init__(parent=parent)
-        self.setAlignment(Qt.AlignHCenter | Qt.AlignVCenter)
-        self.setSizePolicy(QSizePolicy.Ignored, QSizePolicy.Ignored)
-        self.setContentsMargins(5, 5, 5, 5)
-        self.setScaledContents(True)
-        self.set_image(pil_img)
-
-    def set_image(self, pil_img):
-        pix_map = pil2pixmap(pil_img)
-        self.setPixmap(pix_map)
+        self.setUniformItemSizes(True)
+        self.setSelectionMode(QtWidgets.QAbstractItemView.ExtendedSelection)
+        self.setItemDelegate(PageDelegate(parent=self))
 
     def contextMenuEvent(self, event):
         self.menu = QtWidgets.QMenu(self)
         deleteAction = QtWidgets.QAction('Delete', self)
         marginAction = QtWidgets.QAction('Add Margin', self)
+        trimAction = QtWidgets.QAction('Trim Margins', self)
         rescaleAction = QtWidgets.QAction('Rescale', self)
         rotateAction = QtWidgets.QAction('Rotate', self)
 
         deleteAction.triggered.connect(lambda: self.actionEvent.emit("delete"))
-        marginAction.triggered.connect(lambda: self.actionEvent.emit("marginAction"))
+        marginAction.triggered.connect(lambda: self.actionEvent.emit("margin"))
+        trimAction.triggered.connect(lambda: self.actionEvent.emit("trim"))
         rescaleAction.triggered.connect(lambda: self.actionEvent.emit("rescale"))
         rotateAction.triggered.connect(lambda: self.actionEvent.emit("rotate"))
 
         self.menu.addAction(deleteAction)
         self.menu.addAction(marginAction)
+        self.menu.addAction(trimAction)
         self.menu.addAction(rescaleAction)
         self.menu.addAction(rotateAction)
         # add other required actions
@@ -69,6 +225,18 @@ class SelectableImage(QtWidgets.QLabel):
         self.start = (0, 0)
         self.end = (0, 0)
         self.pressed = False
+        self.tiles = dict()
+        self.tile_zoom = None
+
+    def clear_tiles(self, zoom=None):
+        self.tiles.clear()
+        self.tile_zoom = zoom
+        self.update()
+
+    def drop_tiles(self, keep):
+        for tile in list(self.tiles):
+            if tile not in keep:
+                del self.tiles[tile]
 
     def get_selection(self) -> Tuple[float, float, float, float]:
         x1, y1, x2, y2 = *self.start, *self.end
@@ -102,6 +270,14 @@ class SelectableImage(QtWidgets.QLabel):
     def paintEvent(self, event) -> None:
         super().paintEvent(event)
 
+        if self.tiles:
+            qp = QPainter()
+            qp.begin(self)
+            for rect, pix_map in self.tiles.values():
+                if rect.intersects(event.rect()):
+                    qp.drawPixmap(rect, pix_map)
+            qp.end()
+
         if self.start != self.end:
             qp = QPainter()
             qp.begin(self)
@@ -121,12 +297,21 @@ class SelectableImage(QtWidgets.QLabel):
 class ImageViewer(QtWidgets.QWidget):
 
     actionEvent = pyqtSignal(str)
+    tilesRequested = pyqtSignal(float, object)
+
+    TILE_SIZE = 512
 
     def __init__(self, parent=None):
         super().__init__(parent=parent)
 
         self.scaleFactor = 1
 
+        # tiles are only worked out once scrolling or zooming has settled
+        self.tileTimer = QtCore.QTimer(self)
+        self.tileTimer.setSingleShot(True)
+        self.tileTimer.setInterval(50)
+        self.tileTimer.timeout.connect(self.update_tiles)
+
         self.imageLabel = SelectableImage()
         self.imageLabel.setAlignment(Qt.AlignCenter)
         self.imageLabel.setSizePolicy(QSizePolicy.Ignored, QSizePolicy.Ignored)
@@ -137,6 +322,8 @@ class ImageViewer(QtWidgets.QWidget):
         self.imageScrollArea = QScrollArea()
         self.imageScrollArea.setAlignment(Qt.AlignCenter)
         self.imageScrollArea.setWidget(self.imageLabel)
+        self.imageScrollArea.horizontalScrollBar().valueChanged.connect(lambda: self.tileTimer.start())
+        self.imageScrollArea.verticalScrollBar().valueChanged.connect(lambda: self.tileTimer.start())
 
         self.zoomInButton = QPushButton("+")
         self.zoomInButton.setFixedSize(32, 32)
@@ -213,11 +400,13 @@ class ImageViewer(QtWidgets.QWidget):
         self.change_image(pix_map)
 
     def change_image(self, pix_map):
-        self.imageLabel.setPixmap(pix_map)
-        self.imageLabel.adjustSize()
-        # self.cropButton.setVisible(False)
-        self.change_action_bar_visibility(True)
-        self.scale_image(1)
+        with span("layout"):
+            self.imageLabel.clear_tiles()
+            self.imageLabel.setPixmap(pix_map)
+            self.imageLabel.adjustSize()
+            # self.cropButton.setVisible(False)
+            self.change_action_bar_visibility(True)
+            self.scale_image(1)
 
     def change_action_bar_visibility(self, on):
         self.lastButton.setVisible(on)
@@ -232,6 +421,7 @@ class ImageViewer(QtWidgets.QWidget):
     def normal_size(self):
         self.imageLabel.adjustSize()
         self.scaleFactor = 1
+        self.tileTimer.start()
 
     def fit_to_window(self, on):
         self.imageScrollArea.setWidgetResizable(on)
@@ -247,3 +437,69 @@ class ImageViewer(QtWidgets.QWidget):
 
         self._adjust_scroll_bar(self.imageScrollArea.horizontalScrollBar(), factor)
         self._adjust_scroll_bar(self.imageScrollArea.verticalScrollBar(), factor)
+        self.tileTimer.start()
+
+    def _tile_rect(self, tile):
+        col, row = tile
+        rect = QtCore.QRect(col * self.TILE_SIZE, row * self.TILE_SIZE, self.TILE_SIZE, self.TILE_SIZE)
+        return rect.intersected(self.imageLabel.rect())
+
+    def update_tiles(self):
+        # above 1:1 the preview is only stretched, so the visible part is re-rendered in tiles at the zoomed resolution
+        label = self.imageLabel
+        if label.pixmap() is None or self.scaleFactor <= 1:
+            if label.tiles or label.tile_zoom is not None:
+                label.clear_tiles()
+            self.tilesRequested.emit(0, [])
+            return
+
+        zoom = round(self.scaleFactor, 4)
+        if zoom != label.tile_zoom:
+            label.clear_tiles(zoom)
+
+        viewport = self.imageScrollArea.viewport()
+        visible = QtCore.QRect(-label.x(), -label.y(), viewport.width(), viewport.height()).intersected(label.rect())
+        if visible.isEmpty():
+            return
+        nearby = visible.adjusted(-self.TILE_SIZE, -self.TILE_SIZE, self.TILE_SIZE, self.TILE_SIZE)
+
+        def tiles_in(rect):
+            return {(col, row)
+                    for row in range(max(rect.top(), 0) // self.TILE_SIZE, rect.bottom() // self.TILE_SIZE + 1)
+                    for col in range(max(rect.left(), 0) // self.TILE_SIZE, rect.right() // self.TILE_SIZE + 1)}
+
+        # tiles that were scrolled well out of view are evicted
+        label.drop_tiles(tiles_in(nearby))
+
+        width, height = label.width(), label.height()
+        needed = list()
+        for tile in sorted(tiles_in(visible)):
+            rect = self._tile_rect(tile)
+            if tile not in label.tiles and not rect.isEmpty():
+                fraction = rect.x() / width, rect.y() / height, rect.width() / width, rect.height() / height
+                needed.append((tile, fraction, (rect.width(), rect.height())))
+        self.tilesRequested.emit(zoom, needed)
+
+    def set_tile(self, zoom, tile, pil_img):
+        label = self.imageLabel
+        if zoom != label.tile_zoom:
+            return
+        rect = self._tile_rect(tile)
+        label.tiles[tile] = (rect, pil2pixmap(pil_img))
+        label.update(rect)
+
+
+class FirstPaint(QtCore.QObject):
+
+    # emitted once, when the watched widget is painted for the first time
+    painted = pyqtSignal()
+
+    def __init__(self, widget):
+        super().__init__(parent=widget)
+        widget.installEventFilter(self)
+
+    def eventFilter(self, obj, event):
+        if event.type() == QtCore.QEvent.Paint:
+            obj.removeEventFilter(self)
+            self.painted.emit()
+        return False
@@ -0,0 +1,382 @@
+import hashlib
+import os
+import re
+import shutil
+import tempfile
+
+from pdfrw import PdfArray, PdfDict, PdfWriter
+from pdfrw.buildxobj import ViewInfo, get_rotation, getrects
+from pdfrw.objects import PdfIndirect
+from pdfrw.pdfwriter import user_fmt
+
+from cache import file_stat
+from instrument import count, no_progress, span
+from render import pdfrw_lock, stream_digest
+
+
+def deduplicate(pages):
+    # Collapses objects with identical content (fonts, images, form xobjects, ...) reachable from the pages into a
+    # single instance, so that PdfWriter only serializes each of them once. Pages themselves are never merged.
+    # Returns the number of references that were redirected to an existing object.
+    canonical = dict()
+    hashes = dict()
+    visiting = set()
+    visited = list()
+    replaced = 0
+
+    def visit(obj):
+        nonlocal replaced
+        if not isinstance(obj, (PdfDict, PdfArray)):
+            return ("%r" % (obj,)).encode("latin-1", "replace")
+
+        key = id(obj)
+        if key in hashes:
+            return hashes[key]
+        if key in visiting:
+            # objects on a reference cycle are left alone
+            return b"cycle %d" % key
+        visiting.add(key)
+        visited.append(obj)
+
+        digest = hashlib.sha1()
+        if isinstance(obj, PdfDict):
+            digest.update(b"<<")
+            for name, value in sorted(obj.iteritems()):
+                digest.update(name.encode("latin-1"))
+                digest.update(visit(value))
+                replacement = _canonical(value)
+                if replacement is not value:
+                    obj[name] = replacement
+                    replaced += 1
+            if obj.stream is not None:
+                digest.update(b"stream")
+                digest.update(stream_digest(obj))
+        else:
+            digest.update(b"[")
+            for index, value in enumerate(obj):
+                digest.update(visit(value))
+                replacement = _canonical(value)
+                if replacement is not value:
+                    obj[index] = replacement
+                    replaced += 1
+
+        visiting.discard(key)
+        result = hashes[key] = digest.digest()
+        canonical.setdefault(result, obj)
+        return result
+
+    def _canonical(value):
+        if isinstance(value, (PdfDict, PdfArray)) and id(value) in hashes:
+            replacement = canonical[hashes[id(value)]]
+            if replacement is not value and not replacement.indirect:
+                # a shared object has to be written once and referenced, not inlined at every use
+                replacement.indirect = True
+            return replacement
+        return value
+
+    for page in pages:
+        for name, value in page.iteritems():
+            if name != "/Parent":
+                visit(value)
+                replacement = _canonical(value)
+                if replacement is not value:
+                    page[name] = replacement
+                    replaced += 1
+    return replaced
+
+
+def copy_graph(pages):
+    # Copies of the pages and everything reachable from them, sharing what the originals share. Deduplicating and
+    # compressing change the objects they write, and the originals belong to the documents being edited, whose
+    # objects are still referred to by their number in the file when saving incrementally. Copying resolves every
+    # object, so it needs the pdfrw_lock and the copies do not.
+    copies = dict()
+
+    def copy(obj, skip=()):
+        if not isinstance(obj, (PdfDict, PdfArray)):
+            return obj
+        key = id(obj)
+        if key in copies:
+            return copies[key]
+        if isinstance(obj, PdfDict):
+            result = copies[key] = PdfDict()
+            for name, value in obj.iteritems():
+                if name not in skip:
+                    result[name] = copy(value)
+            if obj.stream is not None:
+                result.stream = obj.stream
+                # the stream hash cached by stream_digest stays valid for the same stream data
+                cached = vars(obj).get("_fingerprint")
+                if cached is not None:
+                    result.private._fingerprint = cached
+        else:
+            result = copies[key] = PdfArray()
+            result.extend(copy(value) for value in obj)
+        result.indirect = bool(obj.indirect)
+        return result
+
+    # the writer gives the pages a parent of its own
+    return [copy(page, ("/Parent",)) for page in pages]
+
+
+class _CountingFile:
+
+    REPORT_BYTES = 2 ** 20
+
+    def __init__(self, f, progress):
+        self.f = f
+        self.progress = progress
+        self.written = 0
+        self.reported = 0
+
+    def write(self, data):
+        # pdfrw writes every object and xref line on its own, progress is only reported every REPORT_BYTES
+        self.f.write(data)
+        self.written += len(data)
+        count("bytes written", len(data))
+        if self.written - self.reported >= self.REPORT_BYTES:
+            self.reported = self.written
+            self.progress("Writing", self.written, 0)
+
+
+def write_pdf(pages, path, optimize=True, progress=None):
+    # pages are EditPages, optimize shares identical resources between pages and flate-compresses the streams.
+    # progress is called with (stage, done, total), total is 0 when it is not known up front.
+    #
+    # The file is written next to the target and renamed over it only once complete, so a crash or error halfway
+    # leaves the previous version untouched.
+    progress = progress or no_progress
+
+    flat_pages = list()
+    step = max(1, len(pages) // 100)
+    for i, page in enumerate(pages):
+        flat_pages.append(page.flatten())
+        # the editor needs these for every page it shows, computed here they do not wait for the write below
+        page.view
+        page.fingerprint
+        if i % step == 0:
+            progress("Preparing pages", i, len(pages))
+    progress("Preparing pages", len(pages), len(pages))
+
+    folder = os.path.dirname(os.path.abspath(path))
+    fd, temp_path = tempfile.mkstemp(dir=folder, prefix="." + os.path.basename(path) + ".", suffix=".tmp")
+    try:
+        with os.fdopen(fd, "wb") as f:
+            # only copying waits for the editor's threads, which flatten and fingerprint pages as the user scrolls
+            # and edits, deduplicating and writing the copies does not hold them up
+            progress("Copying objects", 0, 0)
+            with pdfrw_lock, span("copy"):
+                flat_pages = copy_graph(flat_pages)
+            if optimize:
+                progress("Deduplicating resources", 0, 0)
+                with span("deduplicate"):
+                    deduplicate(flat_pages)
+            with span("write", path=path):
+                writer = PdfWriter(compress=optimize)
+                writer.addpages(flat_pages)
+                counting = _CountingFile(f, progress)
+                writer.write(counting)
+                progress("Writing", counting.written, 0)
+            f.flush()
+            os.fsync(f.fileno())
+
+        if os.path.exists(path):
+            shutil.copymode(path, temp_path)
+        else:
+            umask = os.umask(0)
+            os.umask(umask)
+            os.chmod(temp_path, 0o666 & ~umask)
+        os.replace(temp_path, path)
+    except BaseException:
+        if os.path.exists(temp_path):
+            os.remove(temp_path)
+        raise
+
+
+# The file a document was opened from, as far as appending to it is concerned: the reader its pages come from, the
+# order the pages have in the file by now and the pages that earlier incremental saves replaced with an edited version.
+class IncrementalBase:
+
+    def __init__(self, path, reader):
+        self.path = os.path.abspath(path)
+        self.reader = reader
+        self.order = [id(page) for page in reader.pages]
+        self.sources = set(self.order)
+        self.rewritten = set()
+        self.stat = file_stat(path)
+
+
+class _NotAppendable(Exception):
+    pass
+
+
+def _reference(obj):
+    if isinstance(obj, PdfIndirect):
+        return tuple(obj)
+    indirect = getattr(obj, "indirect", None)
+    if isinstance(indirect, tuple):
+        return indirect
+    if indirect is True:
+        # an object created in memory, it has no number in the file to refer to
+        raise _NotAppendable()
+    return None
+
+
+def _format(obj, top=False):
+    # values are taken without resolving them, so untouched objects are referred to instead of being loaded
+    reference = None if top else _reference(obj)
+    if reference is not None:
+        return "%d %d R" % reference
+    if isinstance(obj, PdfDict):
+        if obj.stream is not None:
+            raise _NotAppendable()
+        return "<<" + "".join(" %s %s" % (key, _format(value)) for key, value in dict.items(obj)) + " >>"
+    if isinstance(obj, PdfArray):
+        return "[" + " ".join(_format(value) for value in list.__iter__(obj)) + "]"
+    if hasattr(obj, "indirect"):
+        return str(getattr(obj, "encoded", None) or obj)
+    return user_fmt(obj)
+
+
+def _format_dict(entries):
+    return "<<" + "".join(" %s %s" % (key, value) for key, value in entries.items()) + " >>"
+
+
+def _edited_page(page):
+    # the source page object itself with the edits expressed as /Rotate and /CropBox, which is all an edit without
+    # scaling amounts to, instead of a new page wrapping it
+    source = page.source
+    inheritable = source.inheritable
+    rotation = get_rotation(inheritable.Rotate)
+    entries = {key: _format(value) for key, value in dict.items(source)}
+    entries["/Rotate"] = str((rotation + page.rotate) % 360)
+    if page.viewrect is not None:
+        _, cbox = getrects(inheritable, ViewInfo(viewrect=page.viewrect), rotation)
+        entries["/CropBox"] = _format(PdfArray(cbox))
+    return _format_dict(entries)
+
+
+def _last_xref(path):
+    # offset of the newest cross reference section, if it is a classic table; after a cross reference stream
+    # another table section is not allowed
+    with open(path, "rb") as f:
+        f.seek(max(0, os.path.getsize(path) - 1024))
+        tail = f.read()
+        found = re.findall(rb"startxref\s+(\d+)", tail)
+        if not found:
+            return None
+        offset = int(found[-1])
+        f.seek(offset)
+        if not f.read(4) == b"xref":
+            return None
+    return offset
+
+
+def _append_plan(pages, path, base):
+    if base is None or os.path.abspath(path) != base.path or not os.path.exists(path):
+        return None
+    if file_stat(path) != base.stat or base.reader.Encrypt is not None:
+        return None
+
+    order = [id(page.source) for page in pages]
+    if not base.sources.issuperset(order) or len(set(order)) != len(order):
+        return None
+    if any(_reference(page.source) is None for page in pages):
+        # pages stored as direct objects, which files should not but do have, cannot be replaced by number
+        return None
+    if any(page.scale != 1 for page in pages):
+        return None
+
+    objects = dict()
+    edited = {id(page.source) for page in pages if not page.unedited}
+    for page in pages:
+        if id(page.source) in edited or id(page.source) in base.rewritten:
+            # pages edited back to their original state are written as well, to undo the earlier version
+            objects[_reference(page.source)] = _edited_page(page)
+
+    if order != base.order:
+        root = base.reader.Root.Pages
+        root_reference = _reference(root)
+        # a flat page tree is rewritten in place; pages in nested trees inherit from their intermediate nodes, so
+        # moving them between nodes is left to a full rewrite
+        if any(_reference(dict.get(page.source, "/Parent")) != root_reference for page in pages):
+            return None
+        entries = {key: _format(value) for key, value in dict.items(root)}
+        entries["/Kids"] = "[" + " ".join("%d %d R" % _reference(page.source) for page in pages) + "]"
+        entries["/Count"] = str(len(pages))
+        objects[root_reference] = _format_dict(entries)
+
+    trailer = {key: _format(value) for key, value in dict.items(base.reader)
+               if key in ("/Size", "/Root", "/Info", "/ID")}
+    return objects, trailer, order, edited
+
+
+def append_pdf(pages, path, base, progress=None):
+    # saves an edited document back into the file it was opened from as an incremental update: only the changed page
+    # objects and page tree are appended, along with a cross reference section pointing back to the previous one.
+    # Returns False without touching the file if the edits cannot be expressed that way.
+    progress = progress or no_progress
+    try:
+        with pdfrw_lock:
+            plan = _append_plan(pages, path, base)
+    except _NotAppendable:
+        plan = None
+    previous = plan and _last_xref(path)
+    if not previous:
+        return False
+    objects, trailer, order, edited = plan
+    if not objects:
+        # the file already holds this document
+        return True
+
+    progress("Appending changes", 0, len(objects))
+    with open(path, "r+b") as f:
+        start = f.seek(0, os.SEEK_END)
+        try:
+            offsets = dict()
+            data = b"\n"
+            for reference in sorted(objects):
+                offsets[reference] = start + len(data)
+                data += ("%d %d obj\n%s\nendobj\n" % (reference + (objects[reference],))).encode("latin-1")
+
+            sections = list()
+            for reference in sorted(objects):
+                if sections and sections[-1][-1][0] + 1 == reference[0]:
+                    sections[-1].append(reference)
+                else:
+                    sections.append([reference])
+
+            xref = start + len(data)
+            data += b"xref\n"
+            for section in sections:
+                data += b"%d %d\n" % (section[0][0], len(section))
+                for reference in section:
+                    data += b"%010d %05d n\r\n" % (offsets[reference], reference[1])
+            trailer["/Prev"] = str(previous)
+            data += b"trailer\n" + _format_dict(trailer).encode("latin-1")
+            data += b"\nstartxref\n%d\n%%%%EOF\n" % xref
+
+            with span("append", path=path):
+                f.write(data)
+                f.flush()
+                os.fsync(f.fileno())
+            count("bytes written", len(data))
+        except BaseException:
+            # the file ends where it did before, so it still holds the previous version
+            f.truncate(start)
+            raise
+
+    base.order = order
+    base.rewritten = edited
+    base.stat = file_stat(path)
+    progress("Appending changes", len(objects), len(objects))
+    return True
+
+
+def save_pdf(pages, path, base=None, optimize=True, progress=None):
+    # appends to the file the document was opened from where possible, which only costs as much as the edits,
+    # and writes a new file otherwise. Returns whether the save was incremental.
+    if append_pdf(pages, path, base, progress):
+        return True
+    write_pdf(pages, path, optimize, progress)
+    return False